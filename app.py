@@ -1,96 +1,88 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 import time
 import json
+import hashlib
+import os
+import tempfile
 from datetime import date
 from io import BytesIO
-from docx import Document
-from docx.shared import Inches
-from docx.shared import Pt
-from docx.oxml.ns import nsdecls
-from docx.oxml import parse_xml
-from docx.enum.text import WD_ALIGN_PARAGRAPH # pylint: disable=E0611
-from docx.shared import RGBColor
-import requests
-import base64
-import ast
-
-def lambda_handler(event, context):
-    data = event["body"]
-    if isinstance(data, str):
-        data = json.loads(data)
-    survey_id = data["raw_survey"]["_id"]
-    
-    go(data)
-
-    s3 = boto3.client('s3')
-    s3.upload_file("/tmp/survey_export.docx", 'word-exports-appinio', str(survey_id) + '.docx')
-    url = s3.generate_presigned_url(
-        ClientMethod='get_object',
-        Params={
-            'Bucket': 'word-exports-appinio',
-            'Key': str(survey_id) + '.docx'
-        },
-        ExpiresIn=24 * 3600)
-
-    return {
-        'statusCode': 200,
-        'headers': {
-            "Access-Control-Allow-Credentials": True,
-            "Access-Control-Allow-Headers": "X-Requested-With, Authorization, X-HTTP-Method-Override, Content-Type, Accept",
-            "Access-Control-Allow-Methods": "GET, POST, OPTIONS, DELETE, PUT",
-            "Access-Control-Allow-Origin": "*",
-            "Content-Type": "application/json; charset=UTF-8"
-        },
-        'body': url,
-        "isBase64Encoded": False
-    }
-
-def str2bool(v):
-  return v.lower() in ("True", "true", "t", "1")
-
-def go(inputs):
-    '''process inputs to generate word file displaying the survey archtecture'''
-    survey_raw  = inputs["raw_survey"]
-    include_images = str2bool(inputs["incl_images"])
-    english_lang = str2bool(inputs["english_lang"])
+from images import collect_image_urls, fetch_images, ImageProcessor, DPI, JPEG_QUALITY
+from imagecache import ImageCache, DirectoryStore, S3Store, MEMORY_BUDGET, TTL
+from fragments import FragmentCache, has_pictures
+from ingest import read_request, compact, QUESTION_FIELDS
+from formats import FORMATS, TABLE_HEADINGS, output_formats, text_cells
+from formats import html_document, markdown_document, csv_codebook
+from jobs import JobStore, SQSQueue, JobProgress, job_ids
+from metrics import create_metrics, NULL_METRICS
+from model import normalize
+
+BUCKET = 'word-exports-appinio'
+# part of the export cache key, bump it whenever the rendered document changes
+EXPORT_VERSION = 2
+
+# rendering engine of the question table: "xml" writes the rows as WordprocessingML in bulk,
+# "docx" builds them through python-docx. both produce the same document
+ENGINE = "xml"
+# python-docx (and with it lxml) is imported on the first Word export only, lengths are given in EMU
+EMU_PER_INCH = 914400
+# width of the three table columns: 0.72, 5.1 and 1.5 inches
+COLUMN_WIDTHS = (int(0.72 * EMU_PER_INCH), int(5.1 * EMU_PER_INCH), int(1.50 * EMU_PER_INCH))
+PICTURE_WIDTH = 2 * EMU_PER_INCH
+
+# with a job queue configured (EXPORT_QUEUE_URL), bigger surveys are exported asynchronously
+ASYNC_QUESTIONS = 150
+ASYNC_IMAGES = 30
+
+# exports up to this size stay in memory, bigger ones spill to a private temp file
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+# multipart upload with few parts in flight to keep the upload buffers small
+UPLOAD_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=2)
+
+LOGO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Appinio-Logo.png")
+
+# created on first use and kept for warm invocations
+_s3 = None
+_logo = None
+_template = None
+_image_cache = None
+_fragment_cache = None
+_queue = None
+
+def get_s3():
+    '''S3 client shared between warm invocations'''
+    global _s3  # pylint: disable=W0603
+    if _s3 is None:
+        _s3 = boto3.client('s3')
+    return _s3
+
+def get_logo():
+    '''bytes of the logo used in the page headers'''
+    global _logo  # pylint: disable=W0603
+    if _logo is None:
+        with open(LOGO_PATH, "rb") as f:
+            _logo = f.read()
+    return _logo
+
+def get_template():
+    '''the start of every Word export as docx package: styles and page headers'''
+    global _template  # pylint: disable=W0603
+    if _template is None:
+        _template = build_template()
+    return _template
+
+def build_template():
+    from docx import Document  # pylint: disable=C0415
+    from docx.shared import Inches, Pt, RGBColor  # pylint: disable=C0415
+    from docx.enum.text import WD_ALIGN_PARAGRAPH  # pylint: disable=C0415,E0611
     document = Document()
-    if english_lang:
-        dict_qtypes = {"mc": "Multiple Choice",
-                       "freetext": "Open question",
-                       "info": "Info box",
-                       "matrix": "Matrix",
-                       "likert": "Likert",
-                       "imagecloud": "Multiple Choice (with images)",
-                       "image": "Multiple Choice (with images and text)",
-                       "numericslider": "Numeric slider / NPS",
-                       "ranking": "Ranking",
-                       "starslider": "Stars",
-                       "propertyslider": "Preference slider",
-                       "number": "Number (Open entry)",
-                       "heatmap": "Heatmap",
-                       "videoplay": "Audio/Video",
-                       "photocaptur": "Take photo"}
-    else:
-        dict_qtypes = {"mc": "Multiple Choice",
-                       "freetext": "Offene Frage",
-                       "info": "Infobox",
-                       "matrix": "Matrix",
-                       "likert": "Likert",
-                       "numericslider": "Numerischer Slider / NPS",
-                       "ranking": "Ranking",
-                       "starslider": "Stars",
-                       "propertyslider": "Präferenz-Slider",
-                       "number": "Zahl (Freie Eingabe)",
-                       "heatmap": "Heatmap",
-                       "videoplay": "Audio/Video",
-                       "photocaptur": "Fotoaufnahme"}
 
     # General style
     style = document.styles['Normal']
     font = style.font
     font.name = 'Roboto'
     font.size = Pt(10)
-    paragraph_format = style.paragraph_format
     # Add header for first page with table (logo on the left, address on the right)
     header = document.sections[0].first_page_header
     document.sections[0].different_first_page_header_footer = True
@@ -98,7 +90,7 @@ def go(inputs):
     htab_cells = htable.rows[0].cells
     ht0 = htab_cells[0].paragraphs[0]  # cell including the logo
     kh = ht0.add_run(style=None)
-    kh.add_picture("Appinio-Logo.png", width=Inches(1.401575))
+    kh.add_picture(BytesIO(get_logo()), width=Inches(1.401575))
     # cell including address and contact information
     ht1 = htab_cells[3].paragraphs[0]
     run = ht1.add_run(
@@ -114,7 +106,360 @@ def go(inputs):
     htab_cells = htable.rows[0].cells
     ht0 = htab_cells[0].paragraphs[0]  # cell including the logo
     kh = ht0.add_run(style=None)
-    kh.add_picture("Appinio-Logo.png", width=Inches(1.401575))
+    kh.add_picture(BytesIO(get_logo()), width=Inches(1.401575))
+
+    output = BytesIO()
+    document.save(output)
+    return output.getvalue()
+
+def get_image_cache():
+    '''image cache shared between warm invocations. the persistent tier is configured with the
+    environment variables IMAGE_CACHE_DIR or IMAGE_CACHE_BUCKET (and IMAGE_CACHE_PREFIX)'''
+    global _image_cache  # pylint: disable=W0603
+    if _image_cache is None:
+        ttl = int(os.environ.get("IMAGE_CACHE_TTL", TTL))
+        store = None
+        if os.environ.get("IMAGE_CACHE_DIR"):
+            store = DirectoryStore(os.environ["IMAGE_CACHE_DIR"])
+            store.evict_expired(ttl)
+        elif os.environ.get("IMAGE_CACHE_BUCKET"):
+            store = S3Store(get_s3(), os.environ["IMAGE_CACHE_BUCKET"], os.environ.get("IMAGE_CACHE_PREFIX", "image-cache/"))
+        _image_cache = ImageCache(int(os.environ.get("IMAGE_CACHE_BYTES", MEMORY_BUDGET)), store, ttl)
+    return _image_cache
+
+def get_fragment_cache():
+    '''cache of rendered rows for incremental exports, configured with the environment variables
+    FRAGMENT_CACHE_DIR or FRAGMENT_CACHE_BUCKET (and FRAGMENT_CACHE_PREFIX). None if neither is set'''
+    global _fragment_cache  # pylint: disable=W0603
+    if _fragment_cache is None:
+        if os.environ.get("FRAGMENT_CACHE_DIR"):
+            store = DirectoryStore(os.environ["FRAGMENT_CACHE_DIR"])
+            store.evict_expired(TTL)
+        elif os.environ.get("FRAGMENT_CACHE_BUCKET"):
+            store = S3Store(get_s3(), os.environ["FRAGMENT_CACHE_BUCKET"], os.environ.get("FRAGMENT_CACHE_PREFIX", "fragments/"))
+        else:
+            return None
+        _fragment_cache = FragmentCache(store, EXPORT_VERSION)
+    return _fragment_cache
+
+def get_queue():
+    '''queue of the asynchronous export jobs'''
+    global _queue  # pylint: disable=W0603
+    if _queue is None:
+        _queue = SQSQueue(boto3.client('sqs'), os.environ["EXPORT_QUEUE_URL"])
+    return _queue
+
+def export_key(data, output_format="docx"):
+    '''S3 key of the export of a request: the survey id and a hash over everything that ends up in the document,
+    with the file extension of the output format.
+
+    an export is rebuilt (the cached object is not used anymore) when
+    - the title or any field of the questions of raw_survey that is rendered (ingest.QUESTION_FIELDS) changes.
+      other fields (participant counters, quotas, ...) are not rendered and do not invalidate the export
+    - incl_images, english_lang, image_dpi or image_quality are different
+    - the day changes, the document shows the export date
+    - EXPORT_VERSION is bumped, do this with every change to the rendering
+    images are cached by URL: an image replaced behind the same URL shows up the next day at the latest.
+    old exports are not deleted here, they expire through the lifecycle rules of the bucket'''
+    survey = data["raw_survey"]
+    normalized = {"version": EXPORT_VERSION,
+                  "date": date.today().isoformat(),
+                  "title": survey["title"],
+                  "questions": compact(survey["questions"], QUESTION_FIELDS),
+                  "incl_images": str2bool(data["incl_images"]),
+                  "english_lang": str2bool(data["english_lang"]),
+                  "image_dpi": int(data.get("image_dpi", DPI)),
+                  "image_quality": int(data.get("image_quality", JPEG_QUALITY))}
+    digest = hashlib.sha256(json.dumps(normalized, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+    return str(survey["_id"]) + '/' + digest + '.' + FORMATS[output_format][0]
+
+def export_keys(data):
+    '''output format -> S3 key for the formats of the request, see formats.output_formats'''
+    return {output_format: export_key(data, output_format) for output_format in output_formats(data)}
+
+def export_exists(s3, key):
+    try:
+        s3.head_object(Bucket=BUCKET, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise
+    return True
+
+def run_async(data):
+    '''whether to export asynchronously: on request (field "async") or for big surveys'''
+    if not os.environ.get("EXPORT_QUEUE_URL"):
+        return False
+    if "async" in data:
+        return str2bool(data["async"])
+    questions = data["raw_survey"]["questions"]
+    if len(questions) > ASYNC_QUESTIONS:
+        return True
+    return str2bool(data["incl_images"]) and len(collect_image_urls(questions)) > ASYNC_IMAGES
+
+def presign(s3, key):
+    return s3.generate_presigned_url(
+        ClientMethod='get_object',
+        Params={
+            'Bucket': BUCKET,
+            'Key': key
+        },
+        ExpiresIn=24 * 3600)
+
+def respond(body, status_code=200, headers=None):
+    response_headers = {
+        "Access-Control-Allow-Credentials": True,
+        "Access-Control-Allow-Headers": "X-Requested-With, Authorization, X-HTTP-Method-Override, Content-Type, Accept",
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS, DELETE, PUT",
+        "Access-Control-Allow-Origin": "*",
+        "Content-Type": "application/json; charset=UTF-8"
+    }
+    if headers:
+        response_headers["Access-Control-Expose-Headers"] = ", ".join(headers)
+        response_headers.update(headers)
+    return {
+        'statusCode': status_code,
+        'headers': response_headers,
+        'body': body,
+        "isBase64Encoded": False
+    }
+
+def debug_headers(metrics, debug):
+    '''log the metrics of a request, with debug they are returned in the header X-Export-Metrics as well'''
+    summary = metrics.emit()
+    if debug and summary is not None:
+        return {"X-Export-Metrics": json.dumps(summary, separators=(",", ":"))}
+    return None
+
+def export(s3, data, keys, progress=None, metrics=NULL_METRICS):
+    '''render the export of a request in the formats of keys (output format -> S3 key) and upload them'''
+    outputs = render(data, list(keys), progress, metrics)
+    with metrics.span("upload"):
+        for output_format, output in outputs.items():
+            with output:
+                s3.upload_fileobj(output, BUCKET, keys[output_format], Config=UPLOAD_CONFIG,
+                                  ExtraArgs={"ContentType": FORMATS[output_format][1]})
+
+def export_urls(s3, keys):
+    '''response body of an export: the URL of the document or, for several formats, JSON with a URL per format'''
+    if len(keys) == 1:
+        return presign(s3, next(iter(keys.values())))
+    return json.dumps({output_format: presign(s3, key) for output_format, key in keys.items()})
+
+def lambda_handler(event, context):
+    '''POST: export a survey, returns the URL of the document (see export_urls) or, for asynchronous exports,
+    status 202 and the job id. GET /word/{job_id}: state of an asynchronous export.
+    output_format selects the formats of the export (see formats.py), docx by default.
+    the timings of an export are logged with EXPORT_METRICS set (see metrics.create_metrics),
+    requests with "debug": "true" get them in the response header X-Export-Metrics as well'''
+    if event.get("httpMethod") == "GET":
+        return job_status(event["pathParameters"]["job_id"])
+    data = read_request(event["body"])  # streamed, without the fields the export does not use
+    debug = str2bool(str(data.get("debug", "false")))
+    metrics = create_metrics("lambda_handler", os.environ.get("EXPORT_METRICS"), force=debug)
+    try:
+        keys = export_keys(data)
+    except ValueError as e:
+        return respond(json.dumps({"error": str(e)}), 400)
+
+    s3 = get_s3()
+    with metrics.span("cache_check"):
+        missing = {output_format: key for output_format, key in keys.items() if not export_exists(s3, key)}
+    metrics.record(survey=str(data["raw_survey"]["_id"]), cached=not missing)
+    if missing:
+        if run_async(data):
+            job_id = JobStore(s3, BUCKET).create(data)
+            get_queue().send(job_id)
+            return respond(json.dumps({"job_id": job_id, "status": "queued"}), 202, debug_headers(metrics, debug))
+        export(s3, data, missing, metrics=metrics)
+    return respond(export_urls(s3, keys), headers=debug_headers(metrics, debug))
+
+def job_status(job_id):
+    '''state of an asynchronous export, including the URL of the document once it is done'''
+    s3 = get_s3()
+    state = JobStore(s3, BUCKET).state(job_id)
+    if state is None:
+        return respond(json.dumps({"error": "unknown job"}), 404)
+    if state["status"] == "done":
+        state["url"] = presign(s3, state["key"])
+        if len(state.get("keys", {})) > 1:
+            state["urls"] = {output_format: presign(s3, key) for output_format, key in state["keys"].items()}
+    return respond(json.dumps(state))
+
+def job_handler(event, context):
+    '''worker of the asynchronous exports, triggered by the job queue'''
+    s3 = get_s3()
+    store = JobStore(s3, BUCKET)
+    for job_id in job_ids(event):
+        data = store.request(job_id)
+        state = store.state(job_id)
+        state.update(status="running", started=time.time())
+        store.save(job_id, state)
+        keys = export_keys(data)
+        metrics = create_metrics("job_handler", os.environ.get("EXPORT_METRICS"))
+        metrics.record(survey=str(data["raw_survey"]["_id"]), job_id=job_id)
+        try:
+            export(s3, data, keys, JobProgress(store, job_id, state), metrics)
+        except Exception as e:
+            state.update(status="failed", error=str(e))
+            store.save(job_id, state)
+            raise  # the queue retries the job
+        state.update(status="done", key=next(iter(keys.values())), keys=keys, finished=time.time())
+        store.save(job_id, state)
+        metrics.emit()
+
+def str2bool(v):
+  # bools of JSON bodies as well as strings
+  return str(v).lower() in ("True", "true", "t", "1")
+
+def render_question(cells, question, english_lang, images):
+    '''fill the cells of a table row with a question of the model'''
+    # cell 1 -------------
+    cells[0].paragraphs[0].add_run(question.label).bold = True
+
+    # cell 2 -------------
+    # question wording -------------
+    cells[1].paragraphs[0].add_run(question.text).bold = True
+
+    # Include instructions for participants
+    if question.help is not None:
+        cells[1].add_paragraph(question.help)
+
+    # Include image
+    if images and question.media is not None:
+        run = cells[1].paragraphs[0].add_run()
+        run.add_break()
+        run.add_picture(BytesIO(images[question.media]), width=PICTURE_WIDTH)
+
+    cells[1].add_paragraph()
+
+    # Answers -------------
+    if question.qtype == 'matrix':
+        cells[1].add_paragraph("Answers:" if english_lang else "Antworten:")
+
+    # Answer text and letter, marked when excluded from randomization
+    not_randomized = " (not randomized)" if english_lang else " (nicht randomisiert)"
+    for answer in question.answers:
+        if question.answers_random:
+            cells[1].add_paragraph(answer.letter + ": " + answer.text + (not_randomized if answer.not_randomized else " "))
+        else:
+            cells[1].add_paragraph(answer.letter + ": " + answer.text)
+
+    # free text answer
+    if question.custom_text is not None:
+        cells[1].add_paragraph(question.custom_text + (" (Freetext)" if english_lang else " (Freitext)"))
+
+    # info texts
+    if question.info_text is not None:
+        cells[1].add_paragraph(question.info_text)
+
+    # include images
+    if images:
+        for image_url in question.answer_images:
+            run = cells[1].paragraphs[0].add_run()
+            run.add_picture(BytesIO(images[image_url]), width=PICTURE_WIDTH)
+
+    # matrix scale items
+    if question.rows:
+        suffix = ""
+        if question.rows_random:
+            suffix = not_randomized if question.rows_not_randomized else " "
+        cells[1].add_paragraph()
+        cells[1].add_paragraph("Items:")
+        for item in question.rows:
+            cells[1].add_paragraph(item.letter + ": " + item.text + suffix)
+
+    # likert scale
+    for item in question.key:
+        cells[1].add_paragraph(item.letter + ": " + item.text)
+
+    # cell 3 -------------
+    # "Fragetyp" -------------
+    type_label = question.type_label(english_lang)
+    if type_label is not None:
+        cells[2].paragraphs[0].add_run(type_label)
+
+    # Randomisation
+    if question.rows_random:
+        cells[2].add_paragraph("(Items randomized)" if english_lang else "(Items randomisiert)")
+    if question.answers_random:
+        cells[2].add_paragraph("(Answers randomized)" if english_lang else "(Antworten randomisiert)")
+
+    # Max / min options
+    if question.max_options is not None:
+        cells[2].add_paragraph(("Max Answers: " if english_lang else "Max Antworten: ") + question.max_options)
+    if question.min_options is not None:
+        cells[2].add_paragraph(("Min Answers: " if english_lang else "Min Antworten: ") + question.min_options)
+
+    # Filter
+    if question.has_filters:
+        cells[2].add_paragraph()
+        cells[2].add_paragraph("Filter:")
+    for line in question.filters:
+        cells[2].add_paragraph(line)
+
+def go(inputs, progress=None, metrics=NULL_METRICS):
+    '''process inputs to generate word file displaying the survey archtecture.
+    renders the first format of the input output_format (see formats.py), docx by default.
+    returns the document as a file object positioned at its start'''
+    output_format = output_formats(inputs)[0]
+    return render(inputs, [output_format], progress, metrics)[output_format]
+
+def render(inputs, formats, progress=None, metrics=NULL_METRICS):
+    '''the survey of inputs in each of the output formats, raw_survey is normalized once for all of them.
+    returns output format -> file object positioned at its start'''
+    with metrics.span("normalize"):  # including the resolution of the filters
+        survey = normalize(inputs["raw_survey"])
+    metrics.record(questions_count=len(survey.questions))
+    outputs = {}
+    for output_format in formats:
+        if output_format == "docx":
+            outputs[output_format] = render_docx(survey, inputs, progress, metrics)
+        else:
+            with metrics.span(output_format):
+                outputs[output_format] = render_text(survey, inputs, output_format)
+    return outputs
+
+def render_text(survey, inputs, output_format):
+    '''the normalized survey in one of the text formats, without python-docx'''
+    english_lang = str2bool(inputs["english_lang"])
+    if output_format == "csv":
+        text = csv_codebook(survey, english_lang)
+    else:
+        rows = []
+        for question in survey.questions:
+            cells = text_cells()
+            render_question(cells, question, english_lang, {})
+            rows.append((question, cells))
+        document = html_document if output_format == "html" else markdown_document
+        text = document(survey, rows, english_lang, str2bool(inputs["incl_images"]))
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    output.write(text.encode("utf-8"))
+    output.seek(0)
+    return output
+
+def render_docx(survey, inputs, progress=None, metrics=NULL_METRICS):
+    '''the normalized survey as Word document.
+    the optional inputs image_dpi and image_quality control how images are downscaled and re-encoded,
+    engine selects the rendering engine of the question table (see ENGINE). with a fragment cache configured
+    (see get_fragment_cache) the xml engine only renders the questions that changed since the last export
+    of the survey, unless the input incremental is "false".
+    progress is called with keyword arguments questions_total, questions_rendered, images_total
+    and images_fetched as the export advances, metrics (see metrics.py) gets the timings of the phases.
+    returns the document as a file object positioned at its start'''
+    from docx import Document  # pylint: disable=C0415
+    from docx.shared import Pt, RGBColor  # pylint: disable=C0415
+    from docx.oxml.ns import nsdecls  # pylint: disable=C0415
+    from docx.oxml import parse_xml  # pylint: disable=C0415
+    from docx.enum.text import WD_ALIGN_PARAGRAPH  # pylint: disable=C0415,E0611
+    from wordml import TableWriter  # pylint: disable=C0415
+    progress = progress or (lambda **counters: None)
+    include_images = str2bool(inputs["incl_images"])
+    english_lang = str2bool(inputs["english_lang"])
+    # styles and headers come from the template, loading it is cheaper than building them again
+    document = Document(BytesIO(get_template()))
+    paragraph_format = document.styles['Normal'].paragraph_format
+
     # Add title and date
     document.add_paragraph()
     para = document.add_paragraph()
@@ -124,7 +469,7 @@ def go(inputs):
     para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
     document.add_paragraph()
 
-    run = document.add_paragraph().add_run(survey_raw['title'])
+    run = document.add_paragraph().add_run(survey.title)
     font = run.font
     font.name = 'Roboto Medium'
     font.size = Pt(14)
@@ -137,293 +482,82 @@ def go(inputs):
 
     # populate header row
     heading_cells = table.rows[0].cells
-    if english_lang:
-        heading_cells[0].paragraphs[0].add_run('Question no.').bold = True
-        heading_cells[1].paragraphs[0].add_run('Survey').bold = True
-        heading_cells[2].paragraphs[0].add_run('Question type').bold = True
-    else:
-        heading_cells[0].paragraphs[0].add_run('Frage').bold = True
-        heading_cells[1].paragraphs[0].add_run('Fragebogen').bold = True
-        heading_cells[2].paragraphs[0].add_run('Fragetyp').bold = True
+    for cell, heading in zip(heading_cells, TABLE_HEADINGS[english_lang]):
+        cell.paragraphs[0].add_run(heading).bold = True
+
+    progress(questions_total=len(survey.questions), questions_rendered=0)
+
+    # download all images up front
+    images = {}
+    if include_images:
+        processor = ImageProcessor(int(inputs.get("image_dpi", DPI)), int(inputs.get("image_quality", JPEG_QUALITY)))
+        progress(images_total=len(survey.image_urls), images_fetched=0)
+        with metrics.span("images"):
+            images = fetch_images(survey.image_urls, cache=get_image_cache(), processor=processor,
+                                  progress=lambda fetched: progress(images_fetched=fetched))
+        report = processor.report()
+        metrics.record(images_count=report["images"], embedded_images_count=report["embedded_images"],
+                       image_download_bytes=report["original_bytes"], image_embedded_bytes=report["embedded_bytes"],
+                       image_saved_bytes=report["bytes_saved"])
 
     # contents
-    info_no = 1
-    question_no = 1
-
-    for i in range(len(survey_raw['questions'])):  # question number
-        if survey_raw['questions'][i]['hideForCompany']:
-            continue
-        cells = table.add_row().cells
-
-        # cell 1 -------------
-        if survey_raw['questions'][i]['qtype'] == 'info' or survey_raw['questions'][i]['qtype'] == 'videoplay':
-            cells[0].paragraphs[0].add_run("Info "+str(info_no)).bold = True
-            info_no += 1
-
-        if survey_raw['questions'][i]['qtype'] != 'info' and survey_raw['questions'][i]['qtype'] != 'videoplay':
-            cells[0].paragraphs[0].add_run("F"+str(question_no)).bold = True
-            question_no += 1
-
-        # cell 2 -------------
-        # question wording -------------
-        cells[1].paragraphs[0].add_run(survey_raw['questions'][i]['text']).bold = True
+    if survey.questions:
         paragraph_format.space_before = Pt(2)
         paragraph_format.space_after = Pt(2)
-
-        # Include instructions for participants
-        # check whether instructions for participants exist
-        if "help" in survey_raw['questions'][i]:
-            cells[1].add_paragraph(str(survey_raw['questions'][i]['help']))
-
-        # Include image
-        if include_images:
-            # check whether image URL exist
-            if "media" in survey_raw['questions'][i]:
-                image_url = str(survey_raw['questions'][i]['media'])
-                response = requests.get(image_url)
-                binary_img = BytesIO(response.content)
-                paragraph = cells[1].paragraphs[0]
-                run = paragraph.add_run()
-                run.add_break()
-                run.add_picture(binary_img, width=Inches(2))
-                time.sleep(1)
-
-        cells[1].add_paragraph()
-
-        # Answers -------------
-        if survey_raw['questions'][i]['qtype'] == 'matrix':
-            if english_lang:
-                cells[1].add_paragraph("Answers:").bold = True
-            else:
-                cells[1].add_paragraph("Antworten:").bold = True
-
-        # Answer text and letter
-        answer_letter = 65  # because chr(65) = 'A'
-
-        # Check for randomization
-        random_answer = False
-        random_answer_text = " "
-        for j in range(len(survey_raw['questions'][i]['answers'])):
-            if "random" in survey_raw['questions'][i]['answers'][j]:
-                if survey_raw['questions'][i]['answers'][j]["random"]:
-                    random_answer = True
-
-        # If randomized:
-        if random_answer:
-            for j in range(len(survey_raw['questions'][i]['answers'])):  # answers
-                if not survey_raw['questions'][i]['answers'][j]["random"]:
-                    if english_lang:
-                        random_answer_text = " (not randomized)"
-                    else:
-                        random_answer_text = " (nicht randomisiert)"
-
-                answer_text = str(chr(
-                    answer_letter)+": "+survey_raw['questions'][i]['answers'][j]['text'] + random_answer_text)
-                cells[1].add_paragraph(answer_text)
-                answer_letter += 1
-
-        if not random_answer:
-            for j in range(len(survey_raw['questions'][i]['answers'])):  # answers
-
-                answer_text = str(chr(
-                    answer_letter)+": "+survey_raw['questions'][i]['answers'][j]['text'])
-                cells[1].add_paragraph(answer_text)
-                answer_letter += 1
-
-        # Anweisung für Teilnehmer
-        if "allowCustomText" in survey_raw['questions'][i]:
-            try:
-                if survey_raw['questions'][i]["allowCustomText"] == True:
-                    freetex_answer_test = survey_raw['questions'][i]["customTextName"]
-                    if survey_raw['questions'][i]['answers'][j]["random"] == False:
-                        if english_lang:
-                            cells[1].add_paragraph(
-                                str(str(freetex_answer_test) + " (Freetext)"))
-                        else:
-                            cells[1].add_paragraph(
-                                str(str(freetex_answer_test) + " (Freitext)"))
-
-            except: # pylint: disable=W0702
-                pass
-
-        # info texts
-        if survey_raw['questions'][i]['qtype'] == 'info' or survey_raw['questions'][i]['qtype'] == 'videoplay':
-            try:
-                cells[1].add_paragraph(
-                    str(survey_raw['questions'][i]['infoText']))
-            except: # pylint: disable=W0702
-                pass
-
-        # include images
-        for j in range(len(survey_raw['questions'][i]['answers'])):
-            if include_images:
-                # check whether image URL exist
-                if "imageUrl" in survey_raw['questions'][i]['answers'][j]:
-                    image_url = str(
-                        survey_raw['questions'][i]['answers'][j]['imageUrl'])
-                    print(image_url)
-                    response = requests.get(image_url)
-                    binary_img = BytesIO(response.content)
-                    paragraph = cells[1].paragraphs[0]
-                    run = paragraph.add_run()
-                    run.add_picture(binary_img, width=Inches(2))
-                    time.sleep(1)
-
-        # matrix scale items
-        random_mat_items = False
-        random_mat_items_text = " "
-        for j in range(len(survey_raw['questions'][i]['rows'])):
-            if "random" in survey_raw['questions'][i]['rows'][j]:
-                if survey_raw['questions'][i]['rows'][j]["random"] == True:
-                    random_mat_items = True
-
-        # if randomized
-        if random_mat_items:
-            for j in range(len(survey_raw['questions'][i]['rows'])):  # answers
-                if not survey_raw['questions'][i]['rows'][j]["random"]:
-                    if english_lang:
-                        random_mat_items_text = " (not randomized)"
-                    else:
-                        random_mat_items_text = " (nicht randomisiert)"
-
-            answer_letter = 65  # because chr(65) = 'A'
-            if survey_raw['questions'][i]['rows'] != []:  # Test whether matrix items exist
-                cells[1].add_paragraph()
-                cells[1].add_paragraph("Items:")
-                # matrix items
-                for k in range(len(survey_raw['questions'][i]['rows'])):
-                    item_text = str(chr(
-                        answer_letter) + ": " + survey_raw['questions'][i]['rows'][k]['text'] + random_mat_items_text)
-                    cells[1].add_paragraph(item_text)
-                    answer_letter += 1
-
-        # if not randomized
-        if not random_mat_items:
-
-            answer_letter = 65  # because chr(65) = 'A'
-            if survey_raw['questions'][i]['rows'] != []:  # Test whether matrix items exist
-                cells[1].add_paragraph()
-                cells[1].add_paragraph("Items:")
-                # matrix items
-                for k in range(len(survey_raw['questions'][i]['rows'])):
-                    item_text = str(chr(answer_letter) + ": " +
-                                    survey_raw['questions'][i]['rows'][k]['text'])
-                    cells[1].add_paragraph(item_text)
-                    answer_letter += 1
-
-        # likert scale
-        answer_letter = 65  # because chr(65) = 'A'
-        if survey_raw['questions'][i]['key'] != []:  # Test whether matrix items exist
-            for k in range(len(survey_raw['questions'][i]['key'])):  # matrix items
-                item_text = str(chr(answer_letter) + ": " +
-                                survey_raw['questions'][i]['key'][k]['text'])
-                cells[1].add_paragraph(item_text)
-                answer_letter += 1
-
-        # cell 3 -------------
-        # "Fragetyp" -------------
-
-        if survey_raw['questions'][i]['qtype'] != "mc":
-            for abbreviation, new_label in dict_qtypes.items():
-                if abbreviation == survey_raw['questions'][i]['qtype']:
-                    cells[2].paragraphs[0].add_run(new_label)
+    engine = inputs.get("engine", ENGINE)
+    fragments = None
+    if engine == "xml" and survey.id is not None and str2bool(str(inputs.get("incremental", "true"))):
+        fragment_cache = get_fragment_cache()
+        if fragment_cache is not None:
+            with metrics.span("fragments_load"):
+                fragments = fragment_cache.open(survey.id, english_lang)
+    with metrics.span("rows"):
+        if engine == "xml":
+            rows = TableWriter(document, table, COLUMN_WIDTHS)
+            for rendered, question in enumerate(survey.questions):
+                progress(questions_rendered=rendered)
+                # rows with pictures are not cached, a row cached by an export without images lacks them
+                if fragments is None or has_pictures(question, images):
+                    render_question(rows.add_row(), question, english_lang, images)
+                    continue
+                # incremental: rows of unchanged questions are spliced in as they were rendered before
+                key = fragments.key(question)
+                xml = fragments.get(key)
+                if xml is None:
+                    cells = rows.new_row()
+                    render_question(cells, question, english_lang, images)
+                    xml = rows.row_xml(cells)
+                    fragments.put(key, xml)
+                rows.add_xml(xml)
+            rows.flush()
+            sized_rows = table.rows[:1]  # the written rows carry their widths already
         else:
-            if 'multioptions' in survey_raw['questions'][i]:
-                if survey_raw['questions'][i]['multioptions']:
-                    cells[2].paragraphs[0].add_run("Multiple Choice")
-                else:
-                    cells[2].paragraphs[0].add_run("Single Choice")
-
-        # Randomisation
-        if random_mat_items:
-            if english_lang:
-                cells[2].add_paragraph("(Items randomized)")
-            else:
-                cells[2].add_paragraph("(Items randomisiert)")
-
-        if random_answer:
-            if english_lang:
-                cells[2].add_paragraph("(Answers randomized)")
-            else:
-                cells[2].add_paragraph("(Antworten randomisiert)")
-
-        # Max options
-        if "maxOptions" in survey_raw['questions'][i]:
-            if english_lang:
-                cells[2].add_paragraph(
-                    "Max Answers: "+str(survey_raw['questions'][i]['maxOptions']))
-            else:
-                cells[2].add_paragraph(
-                    "Max Antworten: "+str(survey_raw['questions'][i]['maxOptions']))
-
-        # Min options
-        if "minOptions" in survey_raw['questions'][i]:
-            if english_lang:
-                cells[2].add_paragraph(
-                    "Min Answers: "+str(survey_raw['questions'][i]['minOptions']))
-            else:
-                cells[2].add_paragraph(
-                    "Min Antworten: "+str(survey_raw['questions'][i]['minOptions']))
-
-        # Do filter exist?
-        if survey_raw['questions'][i]["filterRequirements"] != [] or survey_raw['questions'][i]["filterNotRequirements"] != []:
-            cells[2].add_paragraph()
-            cells[2].add_paragraph("Filter:")
-
-        # Filter IF
-        if survey_raw['questions'][i]["filterRequirements"] != []:
-            for k in range(len(survey_raw['questions'][i]["filterRequirements"])):
-                filter_id = str(survey_raw['questions']
-                                [i]["filterRequirements"][k])
-                for l in range(len(survey_raw['questions'])):
-                    if survey_raw['questions'][l]['answers'] != []:
-                        for m in range(len(survey_raw['questions'][l]['answers'])):
-                            if "filterId" in survey_raw['questions'][l]['answers'][m].keys():
-                                if filter_id in survey_raw['questions'][l]['answers'][m]["filterId"]:
-                                    filter_question_no = 1 + l 
-                                    filter_answer_letter = 65 + m
-                                    cells[2].add_paragraph("IF F" + str(filter_question_no) + str(chr(filter_answer_letter)))
-                    elif survey_raw['questions'][l]['key'] != []:
-                        for n in range(len(survey_raw['questions'][l]['key'])):
-                            if filter_id in survey_raw['questions'][l]['key'][n]["filterId"]:
-                                filter_question_no = 1 + l
-                                filter_answer_letter = 65 + n
-                                cells[2].add_paragraph("IF F"+str(filter_question_no)+str(chr(filter_answer_letter)))
-
-        # Filter IF NOT
-        elif survey_raw['questions'][i]["filterNotRequirements"] != []:
-            for k in range(len(survey_raw['questions'][i]["filterNotRequirements"])):
-                filter_id = str(survey_raw['questions']
-                                [i]["filterNotRequirements"][k])
-                for l in range(len(survey_raw['questions'])):
-                    if survey_raw['questions'][l]['answers'] != []:
-                        for m in range(len(survey_raw['questions'][l]['answers'])):
-                            if "filterId" in survey_raw['questions'][l]['answers'][m].keys():
-                                if filter_id in survey_raw['questions'][l]['answers'][m]["filterId"]:
-                                    filter_question_no = 1 + l
-                                    filter_answer_letter = 65 + m
-                                    cells[2].add_paragraph("IF NOT F"+str(filter_question_no)+str(chr(filter_answer_letter)))
-                    if survey_raw['questions'][l]['key'] != []:
-                        for n in range(len(survey_raw['questions'][l]['key'])):
-                            if filter_id in survey_raw['questions'][l]['key'][n]["filterId"]:
-                                filter_question_no = 1 + l
-                                filter_answer_letter = 65 + n
-                                cells[2].add_paragraph("IF NOT F"+str(filter_question_no)+str(chr(filter_answer_letter)))
+            for rendered, question in enumerate(survey.questions):
+                progress(questions_rendered=rendered)
+                render_question(table.add_row().cells, question, english_lang, images)
+            sized_rows = table.rows
 
     # Layout stuff
-    for row in table.rows:
-        for cell, width in zip(row.cells, (Inches(0.72), Inches(5.1), Inches(1.50))):
+    for row in sized_rows:
+        for cell, width in zip(row.cells, COLUMN_WIDTHS):
             cell.width = width
 
     # Set a cell background (shading) color to RGB D9D9D9.
-    shading1 = parse_xml(r'<w:shd {} w:fill="053149"/>'.format(nsdecls('w')))
-    table.cell(0, 0)._tc.get_or_add_tcPr().append(shading1)
-    shading2 = parse_xml(r'<w:shd {} w:fill="053149"/>'.format(nsdecls('w')))
-    table.cell(0, 1)._tc.get_or_add_tcPr().append(shading2)
-    shading3 = parse_xml(r'<w:shd {} w:fill="053149"/>'.format(nsdecls('w')))
-    table.cell(0, 2)._tc.get_or_add_tcPr().append(shading3)
+    # (through the header row, table.cell() would build the cells of the whole table)
+    for cell in heading_cells:
+        shading = parse_xml(r'<w:shd {} w:fill="053149"/>'.format(nsdecls('w')))
+        cell._tc.get_or_add_tcPr().append(shading)
+
+    progress(questions_rendered=len(survey.questions))
+    if fragments is not None:
+        with metrics.span("fragments_save"):
+            fragments.save()
+        metrics.record(fragments_reused_count=fragments.hits, fragments_rendered_count=fragments.misses)
 
     # Save it
-    file_name = survey_raw['title'].replace(":", "-")
-    file_name = file_name.replace("/", "-")
-    document.save('/tmp/survey_export.docx')
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with metrics.span("save"):
+        document.save(output)
+    metrics.record(document_bytes=output.tell())
+    output.seek(0)
+    return output
@@ -0,0 +1,131 @@
+'''batch export of many surveys in one invocation.
+
+invoke the SurveyBatchExportFunction directly (not through the API, the batch takes longer than the
+API timeout) with {"body": {"surveys": [<request>, ...], "zip": "false"}}, every request has the
+fields of a single export (raw_survey, incl_images, english_lang, ...). the surveys are rendered by
+one process per vCPU. images of the whole batch are fetched once, before the processes are forked,
+so all of them share the downloads and the image cache.
+'''
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+import zipfile
+import app
+from app import get_s3, get_image_cache, get_template, export, export_keys, export_exists, presign, respond, str2bool
+from app import BUCKET, SPOOL_MAX_SIZE, UPLOAD_CONFIG
+from ingest import read_request, BATCH_FIELDS
+from images import collect_image_urls, fetch_images, ImageProcessor, DPI, JPEG_QUALITY
+
+
+def map_in_processes(func, items, workers, initializer=None):
+    '''[func(item) for item in items] spread over worker processes, initializer runs first in every process.
+    built on Process and Pipe because Lambda has no /dev/shm, which multiprocessing.Pool needs'''
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    def work(indices, conn):
+        if initializer is not None:
+            initializer()
+        conn.send([(index, func(items[index])) for index in indices])
+        conn.close()
+
+    processes = []
+    for worker in range(workers):
+        indices = list(range(worker, len(items), workers))
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.get_context("fork").Process(target=work, args=(indices, sender))
+        process.start()
+        sender.close()
+        processes.append((process, receiver, indices))
+    results = [None] * len(items)
+    for process, receiver, indices in processes:
+        try:
+            for index, result in receiver.recv():
+                results[index] = result
+        except EOFError:
+            for index in indices:
+                results[index] = {"error": "worker process died"}
+        process.join()
+    return results
+
+
+def prefetch_images(surveys):
+    '''fetch the images of all surveys into the image cache, grouped by their processing settings.
+    failed images are skipped, the surveys using them fail in export_survey and are reported there'''
+    groups = {}
+    for data in surveys:
+        if str2bool(data["incl_images"]):
+            settings = (int(data.get("image_dpi", DPI)), int(data.get("image_quality", JPEG_QUALITY)))
+            groups.setdefault(settings, []).extend(collect_image_urls(data["raw_survey"]["questions"]))
+    for (dpi, quality), urls in groups.items():
+        fetch_images(urls, cache=get_image_cache(), processor=ImageProcessor(dpi, quality), errors={})
+
+
+def export_survey(data):
+    '''export a single survey of the batch, errors are reported instead of failing the batch'''
+    start = time.perf_counter()
+    result = {"survey": str(data["raw_survey"]["_id"])}
+    try:
+        s3 = get_s3()
+        keys = export_keys(data)
+        result["key"] = next(iter(keys.values()))
+        result["keys"] = keys
+        missing = {output_format: key for output_format, key in keys.items() if not export_exists(s3, key)}
+        result["cached"] = not missing
+        if missing:
+            export(s3, data, missing)
+    except Exception as e:  # pylint: disable=W0703
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def reset_s3():
+    '''the S3 client and its connections are not shared with the parent process'''
+    app._s3 = None  # pylint: disable=W0212
+
+
+def zip_exports(s3, results):
+    '''bundle the exported documents into one zip in the bucket, returns its key'''
+    key = "batches/" + uuid.uuid4().hex + ".zip"
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as output:
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as bundle:  # docx files are compressed already
+            for number, result in enumerate(results, 1):
+                if "error" not in result:
+                    for document_key in result["keys"].values():
+                        document = s3.get_object(Bucket=BUCKET, Key=document_key)["Body"].read()
+                        extension = os.path.splitext(document_key)[1]
+                        bundle.writestr("%03d_%s%s" % (number, result["survey"], extension), document)
+        output.seek(0)
+        s3.upload_fileobj(output, BUCKET, key, Config=UPLOAD_CONFIG)
+    return key
+
+
+def batch_handler(event, context):
+    '''export all surveys of the batch, returns a manifest with URL and timing per survey
+    and, if requested with "zip", the URL of a zip with all documents'''
+    data = read_request(event["body"], BATCH_FIELDS)
+    start = time.perf_counter()
+    surveys = data["surveys"]
+    workers = int(data.get("workers", os.cpu_count() or 1))
+
+    # shared by all worker processes
+    get_template()
+    prefetch_images(surveys)
+    results = map_in_processes(export_survey, surveys, workers, reset_s3)
+
+    s3 = get_s3()
+    for result in results:
+        if "error" not in result:
+            result["url"] = presign(s3, result["key"])
+            if len(result["keys"]) > 1:
+                result["urls"] = {output_format: presign(s3, key) for output_format, key in result["keys"].items()}
+    manifest = {"surveys": results, "workers": min(workers, len(surveys))}
+    if str2bool(data.get("zip", "false")):
+        manifest["zip"] = presign(s3, zip_exports(s3, results))
+    manifest["seconds"] = round(time.perf_counter() - start, 3)
+    return respond(json.dumps(manifest))
@@ -0,0 +1,710 @@
+'''performance benchmarks for the survey export, run with: python benchmarks.py <name>'''
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from docx import Document
+from docx.shared import Pt
+from PIL import Image
+import app
+import images
+import ingest
+from app import go
+from metrics import Metrics
+from model import build_filter_index, normalize, QTYPES_EN, QTYPES_DE
+
+
+def synthetic_survey(n_questions=100, n_answers=4, n_key=0, filter_density=0.5, seed=0, n_rows=0,
+                     n_images=0, image_url="http://localhost/"):
+    '''raw_survey with n_questions questions whose filters point at answers of earlier questions.
+    n_images distinct image URLs below image_url are spread over the questions, first as question media,
+    then as answer images'''
+    rnd = random.Random(seed)
+    questions = []
+    filter_ids = []
+    for i in range(n_questions):
+        answers = [{"text": "Answer %d" % j, "filterId": "a%05d%02d" % (i, j), "random": j < n_answers - 1}
+                   for j in range(n_answers)]
+        key = [{"text": "Key %d" % j, "filterId": "k%05d%02d" % (i, j)} for j in range(n_key)]
+        requirements = []
+        if filter_ids and rnd.random() < filter_density:
+            requirements = rnd.sample(filter_ids, min(3, len(filter_ids)))
+        questions.append({"hideForCompany": False,
+                          "qtype": "mc",
+                          "text": "Question %d" % i,
+                          "multioptions": False,
+                          "answers": answers,
+                          "rows": [{"text": "Row %d" % j, "random": j % 2 == 0} for j in range(n_rows)],
+                          "key": key,
+                          "filterRequirements": requirements,
+                          "filterNotRequirements": []})
+        filter_ids += [answer["filterId"] for answer in answers] + [item["filterId"] for item in key]
+
+    slots = [(question, None) for question in questions]
+    for j in range(n_answers):
+        slots += [(question, question["answers"][j]) for question in questions]
+    for m, (question, answer) in enumerate(slots[:n_images]):
+        if answer is None:
+            question["media"] = image_url + "%05d.jpg" % m
+        else:
+            answer["imageUrl"] = image_url + "%05d.jpg" % m
+    return {"_id": "synthetic", "title": "Synthetic survey", "questions": questions}
+
+
+def legacy_filter_labels(questions, filter_id):
+    '''"Filter IF" resolution as it was done before the filter index: a scan over all questions'''
+    labels = []
+    for l in range(len(questions)):
+        if questions[l]['answers'] != []:
+            for m in range(len(questions[l]['answers'])):
+                if "filterId" in questions[l]['answers'][m].keys():
+                    if filter_id in questions[l]['answers'][m]["filterId"]:
+                        labels.append("IF F" + str(1 + l) + chr(65 + m))
+        elif questions[l]['key'] != []:
+            for n in range(len(questions[l]['key'])):
+                if filter_id in questions[l]['key'][n]["filterId"]:
+                    labels.append("IF F" + str(1 + l) + chr(65 + n))
+    return labels
+
+
+def indexed_filter_labels(filter_index, filter_id):
+    '''"Filter IF" resolution through the filter index'''
+    return ["IF F" + str(no) + chr(letter) for no, letter, answers_only in filter_index.get(filter_id, ()) if not answers_only]
+
+
+def bench_filters(sizes=(100, 300, 1000)):
+    '''time resolving all filters of a survey with the legacy scan vs the filter index'''
+    print("%10s %10s %12s %12s" % ("questions", "filters", "legacy [s]", "index [s]"))
+    for size in sizes:
+        questions = synthetic_survey(size, filter_density=1.0)['questions']
+        requirements = [str(f) for question in questions for f in question["filterRequirements"]]
+
+        start = time.perf_counter()
+        legacy = [legacy_filter_labels(questions, f) for f in requirements]
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        filter_index = build_filter_index(questions)
+        indexed = [indexed_filter_labels(filter_index, f) for f in requirements]
+        index_time = time.perf_counter() - start
+
+        assert legacy == indexed
+        print("%10d %10d %12.4f %12.4f" % (size, len(requirements), legacy_time, index_time))
+
+
+def legacy_render_rows(table, survey_raw, english_lang, paragraph_format, filter_index):
+    '''question rows rendered from the raw JSON as before the normalization pass (without images)'''
+    dict_qtypes = QTYPES_EN if english_lang else QTYPES_DE
+    # contents
+    info_no = 1
+    question_no = 1
+
+    for i in range(len(survey_raw['questions'])):  # question number
+        if survey_raw['questions'][i]['hideForCompany']:
+            continue
+        cells = table.add_row().cells
+
+        # cell 1 -------------
+        if survey_raw['questions'][i]['qtype'] == 'info' or survey_raw['questions'][i]['qtype'] == 'videoplay':
+            cells[0].paragraphs[0].add_run("Info "+str(info_no)).bold = True
+            info_no += 1
+
+        if survey_raw['questions'][i]['qtype'] != 'info' and survey_raw['questions'][i]['qtype'] != 'videoplay':
+            cells[0].paragraphs[0].add_run("F"+str(question_no)).bold = True
+            question_no += 1
+
+        # cell 2 -------------
+        # question wording -------------
+        cells[1].paragraphs[0].add_run(survey_raw['questions'][i]['text']).bold = True
+        paragraph_format.space_before = Pt(2)
+        paragraph_format.space_after = Pt(2)
+
+        # Include instructions for participants
+        # check whether instructions for participants exist
+        if "help" in survey_raw['questions'][i]:
+            cells[1].add_paragraph(str(survey_raw['questions'][i]['help']))
+
+        cells[1].add_paragraph()
+
+        # Answers -------------
+        if survey_raw['questions'][i]['qtype'] == 'matrix':
+            if english_lang:
+                cells[1].add_paragraph("Answers:").bold = True
+            else:
+                cells[1].add_paragraph("Antworten:").bold = True
+
+        # Answer text and letter
+        answer_letter = 65  # because chr(65) = 'A'
+
+        # Check for randomization
+        random_answer = False
+        random_answer_text = " "
+        for j in range(len(survey_raw['questions'][i]['answers'])):
+            if "random" in survey_raw['questions'][i]['answers'][j]:
+                if survey_raw['questions'][i]['answers'][j]["random"]:
+                    random_answer = True
+
+        # If randomized:
+        if random_answer:
+            for j in range(len(survey_raw['questions'][i]['answers'])):  # answers
+                if not survey_raw['questions'][i]['answers'][j]["random"]:
+                    if english_lang:
+                        random_answer_text = " (not randomized)"
+                    else:
+                        random_answer_text = " (nicht randomisiert)"
+
+                answer_text = str(chr(
+                    answer_letter)+": "+survey_raw['questions'][i]['answers'][j]['text'] + random_answer_text)
+                cells[1].add_paragraph(answer_text)
+                answer_letter += 1
+
+        if not random_answer:
+            for j in range(len(survey_raw['questions'][i]['answers'])):  # answers
+
+                answer_text = str(chr(
+                    answer_letter)+": "+survey_raw['questions'][i]['answers'][j]['text'])
+                cells[1].add_paragraph(answer_text)
+                answer_letter += 1
+
+        # Anweisung für Teilnehmer
+        if "allowCustomText" in survey_raw['questions'][i]:
+            try:
+                if survey_raw['questions'][i]["allowCustomText"] == True:
+                    freetex_answer_test = survey_raw['questions'][i]["customTextName"]
+                    if survey_raw['questions'][i]['answers'][j]["random"] == False:
+                        if english_lang:
+                            cells[1].add_paragraph(
+                                str(str(freetex_answer_test) + " (Freetext)"))
+                        else:
+                            cells[1].add_paragraph(
+                                str(str(freetex_answer_test) + " (Freitext)"))
+
+            except: # pylint: disable=W0702
+                pass
+
+        # info texts
+        if survey_raw['questions'][i]['qtype'] == 'info' or survey_raw['questions'][i]['qtype'] == 'videoplay':
+            try:
+                cells[1].add_paragraph(
+                    str(survey_raw['questions'][i]['infoText']))
+            except: # pylint: disable=W0702
+                pass
+
+        # matrix scale items
+        random_mat_items = False
+        random_mat_items_text = " "
+        for j in range(len(survey_raw['questions'][i]['rows'])):
+            if "random" in survey_raw['questions'][i]['rows'][j]:
+                if survey_raw['questions'][i]['rows'][j]["random"] == True:
+                    random_mat_items = True
+
+        # if randomized
+        if random_mat_items:
+            for j in range(len(survey_raw['questions'][i]['rows'])):  # answers
+                if not survey_raw['questions'][i]['rows'][j]["random"]:
+                    if english_lang:
+                        random_mat_items_text = " (not randomized)"
+                    else:
+                        random_mat_items_text = " (nicht randomisiert)"
+
+            answer_letter = 65  # because chr(65) = 'A'
+            if survey_raw['questions'][i]['rows'] != []:  # Test whether matrix items exist
+                cells[1].add_paragraph()
+                cells[1].add_paragraph("Items:")
+                # matrix items
+                for k in range(len(survey_raw['questions'][i]['rows'])):
+                    item_text = str(chr(
+                        answer_letter) + ": " + survey_raw['questions'][i]['rows'][k]['text'] + random_mat_items_text)
+                    cells[1].add_paragraph(item_text)
+                    answer_letter += 1
+
+        # if not randomized
+        if not random_mat_items:
+
+            answer_letter = 65  # because chr(65) = 'A'
+            if survey_raw['questions'][i]['rows'] != []:  # Test whether matrix items exist
+                cells[1].add_paragraph()
+                cells[1].add_paragraph("Items:")
+                # matrix items
+                for k in range(len(survey_raw['questions'][i]['rows'])):
+                    item_text = str(chr(answer_letter) + ": " +
+                                    survey_raw['questions'][i]['rows'][k]['text'])
+                    cells[1].add_paragraph(item_text)
+                    answer_letter += 1
+
+        # likert scale
+        answer_letter = 65  # because chr(65) = 'A'
+        if survey_raw['questions'][i]['key'] != []:  # Test whether matrix items exist
+            for k in range(len(survey_raw['questions'][i]['key'])):  # matrix items
+                item_text = str(chr(answer_letter) + ": " +
+                                survey_raw['questions'][i]['key'][k]['text'])
+                cells[1].add_paragraph(item_text)
+                answer_letter += 1
+
+        # cell 3 -------------
+        # "Fragetyp" -------------
+
+        if survey_raw['questions'][i]['qtype'] != "mc":
+            for abbreviation, new_label in dict_qtypes.items():
+                if abbreviation == survey_raw['questions'][i]['qtype']:
+                    cells[2].paragraphs[0].add_run(new_label)
+        else:
+            if 'multioptions' in survey_raw['questions'][i]:
+                if survey_raw['questions'][i]['multioptions']:
+                    cells[2].paragraphs[0].add_run("Multiple Choice")
+                else:
+                    cells[2].paragraphs[0].add_run("Single Choice")
+
+        # Randomisation
+        if random_mat_items:
+            if english_lang:
+                cells[2].add_paragraph("(Items randomized)")
+            else:
+                cells[2].add_paragraph("(Items randomisiert)")
+
+        if random_answer:
+            if english_lang:
+                cells[2].add_paragraph("(Answers randomized)")
+            else:
+                cells[2].add_paragraph("(Antworten randomisiert)")
+
+        # Max options
+        if "maxOptions" in survey_raw['questions'][i]:
+            if english_lang:
+                cells[2].add_paragraph(
+                    "Max Answers: "+str(survey_raw['questions'][i]['maxOptions']))
+            else:
+                cells[2].add_paragraph(
+                    "Max Antworten: "+str(survey_raw['questions'][i]['maxOptions']))
+
+        # Min options
+        if "minOptions" in survey_raw['questions'][i]:
+            if english_lang:
+                cells[2].add_paragraph(
+                    "Min Answers: "+str(survey_raw['questions'][i]['minOptions']))
+            else:
+                cells[2].add_paragraph(
+                    "Min Antworten: "+str(survey_raw['questions'][i]['minOptions']))
+
+        # Do filter exist?
+        if survey_raw['questions'][i]["filterRequirements"] != [] or survey_raw['questions'][i]["filterNotRequirements"] != []:
+            cells[2].add_paragraph()
+            cells[2].add_paragraph("Filter:")
+
+        # Filter IF
+        if survey_raw['questions'][i]["filterRequirements"] != []:
+            for k in range(len(survey_raw['questions'][i]["filterRequirements"])):
+                filter_id = str(survey_raw['questions']
+                                [i]["filterRequirements"][k])
+                for filter_question_no, filter_answer_letter, answers_only in filter_index.get(filter_id, ()):
+                    if not answers_only:
+                        cells[2].add_paragraph("IF F"+str(filter_question_no)+str(chr(filter_answer_letter)))
+
+        # Filter IF NOT
+        elif survey_raw['questions'][i]["filterNotRequirements"] != []:
+            for k in range(len(survey_raw['questions'][i]["filterNotRequirements"])):
+                filter_id = str(survey_raw['questions']
+                                [i]["filterNotRequirements"][k])
+                for filter_question_no, filter_answer_letter, _ in filter_index.get(filter_id, ()):
+                    cells[2].add_paragraph("IF NOT F"+str(filter_question_no)+str(chr(filter_answer_letter)))
+
+    # Layout stuff
+
+
+def bench_render(sizes=(100, 500), repeat=3):
+    '''CPU time per question for rendering the question rows from the raw JSON vs from the normalized model'''
+    print("%10s %18s %18s" % ("questions", "raw JSON [ms/q]", "model [ms/q]"))
+    for size in sizes:
+        survey_raw = synthetic_survey(size, n_answers=6, n_key=2, n_rows=3)
+        legacy = []
+        normalized = []
+        for _ in range(repeat):
+            document = Document()
+            table = document.add_table(1, 3)
+            start = time.process_time()
+            filter_index = build_filter_index(survey_raw['questions'])
+            legacy_render_rows(table, survey_raw, True, document.styles['Normal'].paragraph_format, filter_index)
+            legacy.append(time.process_time() - start)
+
+            table = Document().add_table(1, 3)
+            start = time.process_time()
+            for question in normalize(survey_raw).questions:
+                app.render_question(table.add_row().cells, question, True, {})
+            normalized.append(time.process_time() - start)
+        print("%10d %18.3f %18.3f" % (size, 1000 * min(legacy) / size, 1000 * min(normalized) / size))
+
+
+def scaled_fixture(event_file, factor):
+    '''request of an events/ fixture with its questions repeated factor times, without images'''
+    with open(event_file) as f:
+        data = json.load(f)["body"]
+    data["raw_survey"]["questions"] = data["raw_survey"]["questions"] * factor
+    data["incl_images"] = "false"
+    return data
+
+
+def bench_engines(factors=(10, 30, 100)):
+    '''go() wall time with the python-docx and the WordprocessingML engine on the scaled events/ fixtures'''
+    print("%-32s %7s %10s %10s %10s" % ("fixture", "scale", "questions", "docx [s]", "xml [s]"))
+    for name in sorted(os.listdir("events")):
+        for factor in factors:
+            data = scaled_fixture(os.path.join("events", name), factor)
+            timings = []
+            for engine in ("docx", "xml"):
+                start = time.perf_counter()
+                go(dict(data, engine=engine)).close()
+                timings.append(time.perf_counter() - start)
+            print("%-32s %6dx %10d %10.3f %10.3f" % (name, factor, len(data["raw_survey"]["questions"]), *timings))
+
+
+def reset_warm_state():
+    '''drop the module level singletons, the next invocation behaves like a cold start'''
+    app._s3 = None  # pylint: disable=W0212
+    app._logo = None  # pylint: disable=W0212
+    app._template = None  # pylint: disable=W0212
+    app._image_cache = None  # pylint: disable=W0212
+    images._session = None  # pylint: disable=W0212
+
+
+def bench_handler(event_file="events/624ebad9f436a20014c7e8b7.json", repeat=10):
+    '''lambda_handler latency of a cold vs warm container and of a cached export against a moto S3 stand-in'''
+    from moto import mock_s3  # pylint: disable=C0415
+    import boto3  # pylint: disable=C0415
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with open(event_file) as f:
+        event = json.load(f)
+    with mock_s3():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=app.BUCKET)
+        key = app.export_key(event["body"])
+        cold = []
+        warm = []
+        cached = []
+        for _ in range(repeat):
+            reset_warm_state()
+            for timings in (cold, warm, cached):
+                start = time.perf_counter()
+                app.lambda_handler(event, None)
+                timings.append(time.perf_counter() - start)
+                if timings is cold:
+                    s3.delete_object(Bucket=app.BUCKET, Key=key)  # the warm run renders again
+            s3.delete_object(Bucket=app.BUCKET, Key=key)
+    print("cold start:    %.4f s (median of %d)" % (statistics.median(cold), repeat))
+    print("warm start:    %.4f s (median of %d)" % (statistics.median(warm), repeat))
+    print("cached export: %.4f s (median of %d)" % (statistics.median(cached), repeat))
+
+
+def bench_incremental(sizes=(200, 1000), repeat=3):
+    '''go() wall time of a full export vs an incremental re-export after one question was edited'''
+    import tempfile  # pylint: disable=C0415
+    print("%10s %12s %18s" % ("questions", "full [s]", "incremental [s]"))
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["FRAGMENT_CACHE_DIR"] = directory
+        app._fragment_cache = None  # pylint: disable=W0212
+        for size in sizes:
+            data = {"raw_survey": synthetic_survey(size, n_answers=6, n_key=2, n_rows=3), "incl_images": "false",
+                    "english_lang": "true"}
+            full = []
+            incremental = []
+            for run in range(repeat):
+                start = time.perf_counter()
+                go(dict(data, incremental="false")).close()
+                full.append(time.perf_counter() - start)
+                go(data).close()  # stores the rows
+                data["raw_survey"]["questions"][size // 2]["text"] = "Edited %d" % run
+                start = time.perf_counter()
+                go(data).close()
+                incremental.append(time.perf_counter() - start)
+            print("%10d %12.3f %18.3f" % (size, min(full), min(incremental)))
+        del os.environ["FRAGMENT_CACHE_DIR"]
+        app._fragment_cache = None  # pylint: disable=W0212
+
+
+def inflated_body(event_file, path, size=50 * 1024 * 1024):
+    '''write the API body (JSON text) of an events/ fixture inflated to about size bytes to path,
+    the questions and the blocks the export does not use (quotation, filterExits, ...) are repeated'''
+    with open(event_file) as f:
+        body = json.load(f)["body"]
+    factor = size // len(json.dumps(body)) + 1
+    survey = body["raw_survey"]
+    for key, value in survey.items():
+        if isinstance(value, list):
+            survey[key] = value * factor
+    with open(path, "w") as f:
+        json.dump(body, f)
+    return {}
+
+
+def parse_body(parser, path, trace):
+    '''wall time and, with trace, peak and retained python allocations of parsing the body in path'''
+    with open(path) as f:
+        body = f.read()
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    request = parser(body)
+    result = {"wall_s": round(time.perf_counter() - start, 3), "questions": len(request["raw_survey"]["questions"])}
+    if trace:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result.update(retained_mb=round(current / 1024 / 1024, 1), peak_mb=round(peak / 1024 / 1024, 1))
+    return result
+
+
+def bench_ingest(event_files=("events/624ebad9f436a20014c7e8b7.json", "events/62613d1894a79e001403cb85.json")):
+    '''memory of parsing the fixtures inflated to 50 MB with json.loads vs the streaming ingest.read_request.
+    the 50 MB body itself is part of the peak RSS of both'''
+    import tempfile  # pylint: disable=C0415
+    print("%-32s %-13s %10s %14s %15s %15s" % ("fixture", "parser", "wall [s]", "peak RSS [MB]", "retained [MB]",
+                                                "py peak [MB]"))
+    with tempfile.TemporaryDirectory() as directory:
+        for event_file in event_files:
+            path = os.path.join(directory, os.path.basename(event_file))
+            measure(inflated_body, event_file, path)  # in another process, the parent stays small
+            for name, parser in (("json.loads", json.loads), ("read_request", ingest.read_request)):
+                result = measure(parse_body, parser, path, False)
+                result.update(measure(parse_body, parser, path, True), wall_s=result["wall_s"])
+                print("%-32s %-13s %10.3f %14.1f %15.1f %15.1f" % (
+                    os.path.basename(event_file), name, result["wall_s"], result["peak_rss_mb"],
+                    result["retained_mb"], result["peak_mb"]))
+
+
+class ImageServer:
+    '''local HTTP stand-in for the image host: every path is a different JPEG, served after latency seconds.
+    use as context manager, the images are below .url'''
+
+    def __init__(self, latency=0.05, size=(1200, 900)):
+        self.latency = latency
+        self.size = size
+        self.requests = 0
+        self._images = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=C0103
+                server.requests += 1
+                time.sleep(server.latency)
+                body = server.image(self.path)
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=W0221
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d/" % self._httpd.server_port
+
+    def image(self, path):
+        '''noise compresses badly, the JPEGs are about as big as photos of the same size'''
+        with self._lock:
+            if path not in self._images:
+                image = Image.merge("RGB", [Image.effect_noise(self.size, 40) for _ in range(3)])
+                output = BytesIO()
+                image.save(output, "JPEG", quality=90)
+                self._images[path] = output.getvalue()
+            return self._images[path]
+
+    def preload(self, urls):
+        '''generate the images of urls up front, the measurements only see the latency'''
+        for url in urls:
+            self.image(url[len(self.url) - 1:])
+
+    def __enter__(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def import_times(module="app"):
+    '''{module name: (self, cumulative, depth)} of a fresh interpreter importing module, parsed from the output of
+    python -X importtime. times are in microseconds, depth 0 are the modules imported by the interpreter
+    itself and module, depth 1 the modules module imports and so on'''
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], capture_output=True,
+                            text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return times
+
+
+def cold_import_ms(module="app", repeat=5):
+    '''median import time of module in a fresh interpreter, the part of the Lambda cold start the code controls'''
+    return statistics.median(import_times(module)[module][1] for _ in range(repeat)) / 1000
+
+
+def bench_imports(module="app", repeat=5):
+    '''cold start: import time of module and of the modules it imports directly, median of repeat interpreters'''
+    runs = [import_times(module) for _ in range(repeat)]
+    print("%-24s %12s %12s" % ("module", "self [ms]", "total [ms]"))
+    for name in sorted(runs[0], key=lambda name: -runs[0][name][1]):
+        if name != module and runs[0][name][2] != 1:
+            continue
+        self_ms, total_ms = (statistics.median(run.get(name, (0, 0))[i] for run in runs) / 1000 for i in (0, 1))
+        if total_ms >= 1 or name == module:
+            print("%-24s %12.1f %12.1f" % (name, self_ms, total_ms))
+    print("not imported: " + ", ".join(name for name in ("docx", "lxml", "requests", "PIL") if name not in runs[0]))
+
+
+# knobs of synthetic_survey plus the image latency, images are only downloaded when there are any
+SCENARIOS = [
+    {"name": "small", "questions": 30, "answers": 5, "rows": 0, "key": 0, "filter_density": 0.3, "images": 0},
+    {"name": "matrix", "questions": 150, "answers": 6, "rows": 6, "key": 3, "filter_density": 0.5, "images": 0},
+    {"name": "large", "questions": 1000, "answers": 8, "rows": 2, "key": 2, "filter_density": 0.8, "images": 0},
+    {"name": "images", "questions": 40, "answers": 4, "rows": 0, "key": 0, "filter_density": 0.3, "images": 40,
+     "latency": 0.1},
+]
+
+
+def scenario_request(scenario, image_url="http://localhost/"):
+    '''export request of a SCENARIOS entry'''
+    survey = synthetic_survey(scenario["questions"], scenario["answers"], scenario["key"], scenario["filter_density"],
+                              n_rows=scenario["rows"], n_images=scenario["images"], image_url=image_url)
+    return {"raw_survey": survey, "incl_images": str(scenario["images"] > 0), "english_lang": "true"}
+
+
+def measure(func, *args):
+    '''run func(*args) in a forked process so that every measurement starts from the same (cold) state and
+    gets its own peak RSS. func returns a dict of measurements, the peak RSS in MB is added to it'''
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def work():
+        reset_warm_state()
+        result = func(*args)
+        result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        sender.send(result)
+        sender.close()
+
+    process = multiprocessing.get_context("fork").Process(target=work)
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": "benchmark process died with exit code %s" % process.exitcode}
+    process.join()
+    return result
+
+
+def run_go(data):
+    metrics = Metrics("benchmarks")
+    start = time.perf_counter()
+    output = go(data, metrics=metrics)
+    wall = time.perf_counter() - start
+    output.seek(0, os.SEEK_END)
+    phases = {name: phase["ms"] for name, phase in metrics.summary()["phases"].items()}
+    return {"wall_s": round(wall, 4), "output_bytes": output.tell(), "phases_ms": phases}
+
+
+def run_handler(data):
+    '''lambda_handler against a moto S3 stand-in, a cold container without cached export'''
+    from moto import mock_s3  # pylint: disable=C0415
+    import boto3  # pylint: disable=C0415
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(name, "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.pop("EXPORT_QUEUE_URL", None)  # always export synchronously
+    with mock_s3():
+        boto3.client("s3").create_bucket(Bucket=app.BUCKET)
+        start = time.perf_counter()
+        response = app.lambda_handler({"body": json.dumps(data)}, None)
+        wall = time.perf_counter() - start
+        size = app.get_s3().head_object(Bucket=app.BUCKET, Key=app.export_key(data))["ContentLength"]
+    return {"wall_s": round(wall, 4), "output_bytes": size, "status_code": response["statusCode"]}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, check=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_suite(scenarios=SCENARIOS, targets=(("go", run_go), ("lambda_handler", run_handler))):
+    '''wall time, peak RSS and output size of every target for every scenario'''
+    results = []
+    for scenario in scenarios:
+        with ImageServer(scenario.get("latency", 0)) as server:
+            data = scenario_request(scenario, server.url)
+            server.preload(images.collect_image_urls(data["raw_survey"]["questions"]))
+            for target, func in targets:
+                result = dict(scenario=scenario["name"], target=target, **measure(func, data))
+                results.append(result)
+    results.append({"scenario": "cold_start", "target": "import app", "wall_s": cold_import_ms() / 1000})
+    return {"revision": git_revision(), "python": platform.python_version(), "created": time.time(),
+            "scenarios": scenarios, "results": results}
+
+
+def bench_suite(output=None):
+    '''run the SCENARIOS and write the results to bench_results/<git revision>.json,
+    compare two result files with: python benchmarks.py compare <old.json> <new.json>'''
+    report = run_suite()
+    print("%-10s %-15s %10s %14s %14s" % ("scenario", "target", "wall [s]", "peak RSS [MB]", "output [KB]"))
+    for result in report["results"]:
+        print("%-10s %-15s %10.3f %14.1f %14.1f" % (result["scenario"], result["target"], result.get("wall_s", 0),
+                                                    result.get("peak_rss_mb", 0), result.get("output_bytes", 0) / 1024))
+    if output is None:
+        os.makedirs("bench_results", exist_ok=True)
+        output = os.path.join("bench_results", report["revision"] + ".json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("results written to " + output)
+
+
+def compare_results(old_file, new_file):
+    '''relative change of every measurement between two bench_suite result files'''
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    baseline = {(result["scenario"], result["target"]): result for result in old["results"]}
+    print("%s -> %s" % (old["revision"], new["revision"]))
+    print("%-10s %-15s %10s %14s %14s" % ("scenario", "target", "wall", "peak RSS", "output"))
+    for result in new["results"]:
+        before = baseline.get((result["scenario"], result["target"]))
+        if before is None:
+            continue
+        changes = []
+        for metric in ("wall_s", "peak_rss_mb", "output_bytes"):
+            if before.get(metric) and metric in result:
+                changes.append("%+.1f%%" % (100 * (result[metric] / before[metric] - 1)))
+            else:
+                changes.append("-")
+        print("%-10s %-15s %10s %14s %14s" % (result["scenario"], result["target"], *changes))
+
+
+BENCHMARKS = {"filters": bench_filters, "render": bench_render, "engines": bench_engines, "handler": bench_handler,
+              "incremental": bench_incremental, "ingest": bench_ingest, "imports": bench_imports,
+              "suite": bench_suite}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["compare"]:
+        compare_results(sys.argv[2], sys.argv[3])
+    else:
+        for name in sys.argv[1:] or BENCHMARKS:
+            print("## " + name)
+            BENCHMARKS[name]()
@@ -0,0 +1,183 @@
+'''output formats of the export besides the Word document.
+
+the text formats never touch python-docx. HTML and Markdown show the same table as the Word document:
+app.render_question fills TextCells, which keep the paragraphs and bold runs as plain text. the CSV
+codebook is written from the model directly, one line per question and per answer, item or scale point.
+'''
+import csv
+import io
+import re
+from datetime import date
+from html import escape
+
+# output_format -> (file extension, content type)
+FORMATS = {"docx": ("docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+           "html": ("html", "text/html; charset=utf-8"),
+           "markdown": ("md", "text/markdown; charset=utf-8"),
+           "csv": ("csv", "text/csv; charset=utf-8")}
+
+TABLE_HEADINGS = {True: ("Question no.", "Survey", "Question type"),
+                  False: ("Frage", "Fragebogen", "Fragetyp")}
+
+CODEBOOK_COLUMNS = ("question", "kind", "code", "text", "type", "randomized", "min", "max", "filter")
+
+_MARKDOWN_SPECIAL = re.compile(r"([\\`*_\[\]<>#|])")
+
+
+class TextRun:
+    __slots__ = ("text", "bold")
+
+    def __init__(self, text=""):
+        self.text = text
+        self.bold = False
+
+    def add_break(self):
+        self.text += "\n"
+
+    def add_picture(self, image_descriptor, width):
+        pass  # rendered without images, see html_document
+
+
+class TextParagraph:
+    __slots__ = ("runs",)
+
+    def __init__(self):
+        self.runs = []
+
+    def add_run(self, text=""):
+        run = TextRun(text)
+        self.runs.append(run)
+        return run
+
+
+class TextCell:
+    '''table cell with the part of the python-docx cell API that render_question uses'''
+    __slots__ = ("paragraphs",)
+
+    def __init__(self):
+        self.paragraphs = [TextParagraph()]
+
+    def add_paragraph(self, text=""):
+        paragraph = TextParagraph()
+        if text:
+            paragraph.add_run(text)
+        self.paragraphs.append(paragraph)
+        return paragraph
+
+
+def text_cells():
+    '''cells of a table row for render_question'''
+    return [TextCell() for _ in TABLE_HEADINGS[True]]
+
+
+def output_formats(data):
+    '''the formats of the field output_format of a request: one name, names separated by commas or a list.
+    docx without the field, raises ValueError for unknown formats'''
+    value = data.get("output_format", "docx")
+    names = value if isinstance(value, list) else str(value).split(",")
+    names = list(dict.fromkeys(str(name).strip().lower() for name in names if str(name).strip()))
+    unknown = [name for name in names if name not in FORMATS]
+    if unknown or not names:
+        raise ValueError("unknown output_format %s, use %s" % (", ".join(unknown) or "''", ", ".join(FORMATS)))
+    return names
+
+
+def export_date():
+    return 'Hamburg, ' + date.today().strftime("%d.%m.%Y")
+
+
+def _html_paragraph(paragraph):
+    parts = []
+    for run in paragraph.runs:
+        text = escape(run.text).replace("\n", "<br>")
+        parts.append("<b>" + text + "</b>" if run.bold and text else text)
+    return "<p>" + "".join(parts) + "</p>"
+
+
+def html_document(survey, rows, english_lang, include_images):
+    '''the export as HTML table, rows are the (question, cells) of render_question.
+    images are linked, not embedded, and shown below the question text like in the Word document'''
+    lines = ['<!DOCTYPE html>',
+             '<html lang="%s"><head><meta charset="utf-8"><title>%s</title>' % ("en" if english_lang else "de",
+                                                                                escape(survey.title)),
+             '<style>body{font-family:Roboto,sans-serif;font-size:10pt}table{border-collapse:collapse}'
+             'td,th{border:1px solid #000;padding:2px 6px;vertical-align:top;text-align:left}'
+             'th{background:#053149;color:#fff}p{margin:2px 0}img{width:2in}</style></head><body>',
+             '<p style="text-align:right">%s</p>' % export_date(),
+             '<h1>%s</h1>' % escape(survey.title),
+             '<table>',
+             '<tr>' + "".join('<th>%s</th>' % heading for heading in TABLE_HEADINGS[english_lang]) + '</tr>']
+    for question, cells in rows:
+        html = ["".join(_html_paragraph(paragraph) for paragraph in cell.paragraphs) for cell in cells]
+        urls = ([question.media] if question.media is not None else []) + question.answer_images
+        if include_images and urls:
+            first = _html_paragraph(cells[1].paragraphs[0])
+            images = "".join('<img src="%s" alt="">' % escape(url) for url in urls)
+            html[1] = first + "<p>" + images + "</p>" + html[1][len(first):]
+        lines.append("<tr>" + "".join("<td>" + cell + "</td>" for cell in html) + "</tr>")
+    lines += ['</table>', '</body></html>', '']
+    return "\n".join(lines)
+
+
+def _markdown_paragraph(paragraph):
+    parts = []
+    for run in paragraph.runs:
+        text = _MARKDOWN_SPECIAL.sub(r"\\\1", run.text).replace("\n", "  \n")
+        parts.append("**" + text + "**" if run.bold and text.strip() else text)
+    return "".join(parts).strip()
+
+
+def _markdown_blocks(paragraphs):
+    '''consecutive paragraphs as lines of one block, empty paragraphs separate the blocks'''
+    blocks = [[]]
+    for paragraph in paragraphs:
+        text = _markdown_paragraph(paragraph)
+        if text:
+            blocks[-1].append(text)
+        elif blocks[-1]:
+            blocks.append([])
+    return ["  \n".join(block) for block in blocks if block]
+
+
+def markdown_document(survey, rows, english_lang, include_images):
+    '''the export as Markdown, a section per question with the survey column followed by the question type column'''
+    blocks = ["# " + _MARKDOWN_SPECIAL.sub(r"\\\1", survey.title), export_date()]
+    for question, cells in rows:
+        blocks.append("## " + question.label)
+        survey_blocks = _markdown_blocks(cells[1].paragraphs)
+        urls = ([question.media] if question.media is not None else []) + question.answer_images
+        if include_images and urls:
+            survey_blocks[1:1] = [" ".join("![](%s)" % url for url in urls)]
+        blocks += survey_blocks + _markdown_blocks(cells[2].paragraphs)
+    return "\n\n".join(blocks) + "\n"
+
+
+def csv_codebook(survey, english_lang):
+    '''codebook of the survey: a line per question with its type, randomization, limits and filters,
+    followed by a line per answer ("answer", "freetext"), matrix item ("item") and scale point ("scale")'''
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(CODEBOOK_COLUMNS)
+    for question in survey.questions:
+        randomized = [name for name, random in (("answers", question.answers_random), ("items", question.rows_random))
+                      if random]
+        writer.writerow([question.label, "info" if question.is_info else "question", "", question.text,
+                         question.type_label(english_lang) or question.qtype, ", ".join(randomized),
+                         question.min_options or "", question.max_options or "", "; ".join(question.filters)])
+        for answer in question.answers:
+            random = ""
+            if question.answers_random:
+                random = "no" if answer.not_randomized else "yes"
+            writer.writerow([question.label, "answer", answer.letter, answer.text, "", random, "", "", ""])
+        if question.custom_text is not None:
+            writer.writerow([question.label, "freetext", "", question.custom_text, "", "", "", "", ""])
+        if question.info_text is not None:
+            writer.writerow([question.label, "infotext", "", question.info_text, "", "", "", "", ""])
+        for item in question.rows:
+            random = ""
+            if question.rows_random:
+                random = "partly" if question.rows_not_randomized else "yes"
+            writer.writerow([question.label, "item", item.letter, item.text, "", random, "", "", ""])
+        for item in question.key:
+            writer.writerow([question.label, "scale", item.letter, item.text, "", "", "", "", ""])
+    return output.getvalue()
@@ -0,0 +1,85 @@
+'''cache of rendered table rows for incremental exports.
+
+an export keeps the WordprocessingML of its question rows, keyed by a hash over the normalized question
+(label and resolved filter lines included, so rows whose filter targets moved are rendered again), the
+language and the export version. the next export of the survey splices the rows of unchanged questions
+back into the table and renders only the others. the rows of a survey are stored together, one compressed
+object per survey and language: one read and at most one write per export.
+rows with pictures are always rendered, their relationship ids belong to the document they were made for.
+the store is a DirectoryStore or S3Store of imagecache.
+'''
+import hashlib
+import json
+import zlib
+from model import Item, Question
+
+
+def question_key(question, salt):
+    '''hash over everything of a normalized question that ends up in its row'''
+    fields = [salt]
+    for name in Question.__slots__:
+        value = getattr(question, name)
+        if isinstance(value, list):
+            value = [[item.letter, item.text, item.not_randomized] if isinstance(item, Item) else item
+                     for item in value]
+        fields.append(value)
+    return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+
+def has_pictures(question, images):
+    '''whether render_question embeds pictures in the row of question'''
+    return bool(images) and (question.media is not None or bool(question.answer_images))
+
+
+class SurveyFragments:
+    '''the cached rows of one export: look up every question with get(), put() the rendered ones
+    and save() the rows of this export afterwards'''
+
+    def __init__(self, store, name, salt):
+        self.store = store
+        self.name = name
+        self.salt = salt
+        self.hits = 0
+        self.misses = 0
+        self._cached = {}
+        data = store.get(name)
+        if data is not None:
+            try:
+                self._cached = json.loads(zlib.decompress(data))
+            except (zlib.error, ValueError):
+                pass  # unreadable, the survey is rendered in full and the rows are stored again
+        self._used = {}
+
+    def key(self, question):
+        return question_key(question, self.salt)
+
+    def get(self, key):
+        '''XML of the row or None'''
+        xml = self._cached.get(key)
+        if xml is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._used[key] = xml
+        return xml
+
+    def put(self, key, xml):
+        self._used[key] = xml
+
+    def save(self):
+        '''store the rows of this export, rows of questions that are gone or changed are dropped'''
+        if self._used.keys() != self._cached.keys():
+            self.store.put(self.name, zlib.compress(json.dumps(self._used).encode(), 1))
+
+
+class FragmentCache:
+    '''rendered rows of the surveys in a store, version invalidates all of them (see app.EXPORT_VERSION)'''
+
+    def __init__(self, store, version):
+        self.store = store
+        self.version = version
+
+    def open(self, survey_id, english_lang):
+        '''SurveyFragments of an export of survey_id'''
+        name = hashlib.sha256(str(survey_id).encode()).hexdigest() + ("-en" if english_lang else "-de")
+        return SurveyFragments(self.store, name, "%s %s" % (self.version, english_lang))
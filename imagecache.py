@@ -0,0 +1,185 @@
+'''two tier cache for the (downscaled) images embedded in the exports.
+
+the first tier is an in-process LRU with a byte budget that lives as long as the warm container,
+the optional second tier is a directory or an S3 prefix shared between containers.
+entries are looked up by URL, the image data itself is stored content addressed (sha256 of the
+downloaded original plus the processing variant) so that the same image behind different URLs is
+only stored once. entries older than the TTL are revalidated against the server with their ETag.
+the persistent tier drops files that were not written within the TTL: DirectoryStore.evict_expired
+for directories, an expiration lifecycle rule on the prefix for S3.
+'''
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+
+MEMORY_BUDGET = 24 * 1024 * 1024  # bytes, leaves enough of the 128 MB for python-docx
+TTL = 7 * 24 * 3600  # seconds
+
+
+class CacheEntry:
+    '''cached image of one URL, size is the byte size of the downloaded original'''
+    __slots__ = ("etag", "digest", "data", "size", "stored_at")
+
+    def __init__(self, etag, digest, data, size, stored_at=None):
+        self.etag = etag
+        self.digest = digest
+        self.data = data
+        self.size = size
+        self.stored_at = time.time() if stored_at is None else stored_at
+
+    def fresh(self, ttl):
+        return time.time() - self.stored_at < ttl
+
+
+def content_key(content, variant):
+    '''content address of an image after processing it with the given variant'''
+    return hashlib.sha256(content).hexdigest() + "-" + variant
+
+
+def url_key(url, variant):
+    return hashlib.sha256((variant + " " + url).encode()).hexdigest()
+
+
+class DirectoryStore:
+    '''persistent tier in a local directory (e.g. /tmp or a mounted EFS volume)'''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.path, key))
+
+    def put(self, key, data):
+        # write and rename, concurrent readers never see half written files. the temporary name is unique
+        # across the threads, forked batch workers and containers sharing the directory
+        path = os.path.join(self.path, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def evict_expired(self, ttl):
+        '''remove all files not written within the last ttl seconds'''
+        cutoff = time.time() - ttl
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass  # renamed or evicted by another container sharing the directory
+
+
+class S3Store:
+    '''persistent tier under a prefix of an S3 bucket'''
+
+    def __init__(self, client, bucket, prefix=""):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read()
+
+    def exists(self, key):
+        '''existence check without downloading the object'''
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+
+class ImageCache:
+    '''URL -> CacheEntry with an LRU memory tier and an optional persistent store'''
+
+    def __init__(self, budget=MEMORY_BUDGET, store=None, ttl=TTL):
+        self.budget = budget
+        self.store = store
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url, variant):
+        '''cached entry of url or None, stale entries are returned as well (see CacheEntry.fresh)'''
+        key = url_key(url, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if self.store is None:
+            return None
+        meta = self.store.get("urls/" + key)
+        if meta is None:
+            return None
+        meta = json.loads(meta)
+        data = self.store.get("blobs/" + meta["digest"])
+        if data is None:
+            return None
+        entry = CacheEntry(meta["etag"], meta["digest"], data, meta["size"], meta["stored_at"])
+        self._remember(key, entry)
+        return entry
+
+    def put(self, url, variant, etag, content, data):
+        '''store data, the result of processing the downloaded content of url'''
+        entry = CacheEntry(etag, content_key(content, variant), data, len(content))
+        key = url_key(url, variant)
+        self._remember(key, entry)
+        if self.store is not None:
+            if not self.store.exists("blobs/" + entry.digest):
+                self.store.put("blobs/" + entry.digest, data)
+            self._save_meta(key, entry)
+        return entry
+
+    def touch(self, url, variant, entry):
+        '''mark a stale entry as fresh again after the server confirmed its ETag'''
+        entry.stored_at = time.time()
+        if self.store is not None:
+            self._save_meta(url_key(url, variant), entry)
+
+    def _save_meta(self, key, entry):
+        meta = {"etag": entry.etag, "digest": entry.digest, "size": entry.size, "stored_at": entry.stored_at}
+        self.store.put("urls/" + key, json.dumps(meta).encode())
+
+    def _remember(self, key, entry):
+        if len(entry.data) > self.budget:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.data)
+            self._entries[key] = entry
+            self.size += len(entry.data)
+            while self.size > self.budget:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.data)
@@ -0,0 +1,220 @@
+'''concurrent download and downscaling of the images referenced in a survey'''
+import hashlib
+import threading
+import time
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+MAX_WORKERS = 8  # overall number of parallel downloads
+MAX_PER_HOST = 4  # parallel downloads against a single host
+MIN_INTERVAL = 0.05  # seconds between two request starts on the same host
+RETRIES = 3
+BACKOFF = 0.5  # seconds, doubled after every failed attempt
+RETRY_STATUS = (429, 500, 502, 503, 504)
+TIMEOUT = 10
+DISPLAY_WIDTH = 2  # inches, width of the images in the export
+DPI = 150
+JPEG_QUALITY = 85
+MAX_DECODES = 2  # images decoded at the same time, independent of the downloads (a 12 MP photo takes ~36 MB)
+
+_session = None
+_decode_slots = threading.BoundedSemaphore(MAX_DECODES)
+
+
+class HostLimiter:
+    '''bounds concurrency and request rate per host'''
+
+    def __init__(self, max_per_host=MAX_PER_HOST, min_interval=MIN_INTERVAL):
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._next_start = {}
+
+    def _slot(self, host):
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[host]
+
+    def _wait_turn(self, host):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
+
+    def get(self, session, url, headers=None):
+        host = urlparse(url).netloc
+        with self._slot(host):
+            self._wait_turn(host)
+            return session.get(url, timeout=TIMEOUT, headers=headers)
+
+
+def get_session():
+    '''pooled keep-alive session, shared between warm invocations'''
+    global _session  # pylint: disable=W0603
+    if _session is None:
+        # requests is only imported by exports with images, it is not part of the cold start otherwise
+        import requests  # pylint: disable=C0415
+        from requests.adapters import HTTPAdapter  # pylint: disable=C0415
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def collect_image_urls(questions):
+    '''all image URLs (question media and answer images) in rendering order, without duplicates'''
+    urls = []
+    for question in questions:
+        if question['hideForCompany']:
+            continue
+        if "media" in question:
+            urls.append(str(question['media']))
+        for answer in question['answers']:
+            if "imageUrl" in answer:
+                urls.append(str(answer['imageUrl']))
+    return list(dict.fromkeys(urls))
+
+
+def download(url, session, limiter, headers=None):
+    '''GET url, retrying with exponential backoff on transient errors'''
+    import requests  # pylint: disable=C0415
+    delay = BACKOFF
+    for attempt in range(RETRIES + 1):
+        try:
+            response = limiter.get(session, url, headers)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == RETRIES:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUS or attempt == RETRIES:
+                response.raise_for_status()
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        time.sleep(delay)
+        delay *= 2
+    return None
+
+
+def downscale(content, width, quality=JPEG_QUALITY):
+    '''shrink an image to at most width pixels and re-encode it, returns content if that does not make it smaller'''
+    from PIL import Image, ImageOps  # pylint: disable=C0415
+    try:
+        image = Image.open(BytesIO(content))
+        if image.format == "JPEG":
+            # decode at the smallest DCT scale that still covers width (in either orientation, see exif_transpose)
+            image.draft("RGB", (width, width))
+        image.load()
+    except (OSError, Image.DecompressionBombError):
+        return content  # nothing Pillow can read, embed it as it is
+    png = image.format == "PNG" or image.mode in ("RGBA", "LA", "P")
+    image = ImageOps.exif_transpose(image)  # the orientation tag is not kept when re-encoding
+    if image.width > width:
+        image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+    output = BytesIO()
+    if png:
+        image.save(output, "PNG", optimize=True)
+    else:
+        image.convert("RGB").save(output, "JPEG", quality=quality, optimize=True)
+    data = output.getvalue()
+    return data if len(data) < len(content) else content
+
+
+class ImageProcessor:
+    '''prepares the downloaded images for embedding: downscaling to the DPI needed for the display
+    width and re-encoding. identical images are processed once and share the same bytes, which
+    python-docx then embeds as a single image part'''
+
+    def __init__(self, dpi=DPI, quality=JPEG_QUALITY, display_width=DISPLAY_WIDTH):
+        self.width = int(display_width * dpi)
+        self.quality = quality
+        # identifies the processing applied to the cached images
+        self.variant = "w%d-q%d" % (self.width, quality)
+        self._processed = {}  # sha256 of the original -> processed image
+        self._sizes = {}  # url -> (size of the original, processed image)
+        self._lock = threading.Lock()
+
+    def process(self, content):
+        digest = hashlib.sha256(content).digest()
+        with self._lock:
+            if digest in self._processed:
+                return self._processed[digest]
+        with _decode_slots:
+            data = downscale(content, self.width, self.quality)
+        with self._lock:
+            return self._processed.setdefault(digest, data)
+
+    def record(self, url, original_size, data):
+        '''remember what an url contributes to the export for the report'''
+        with self._lock:
+            self._sizes[url] = (original_size, data)
+
+    def report(self):
+        '''image count and bytes of the originals vs the bytes embedded into the document'''
+        original = sum(size for size, _ in self._sizes.values())
+        embedded = {hashlib.sha256(data).digest(): len(data) for _, data in self._sizes.values()}
+        return {"images": len(self._sizes),
+                "embedded_images": len(embedded),
+                "original_bytes": original,
+                "embedded_bytes": sum(embedded.values()),
+                "bytes_saved": original - sum(embedded.values())}
+
+
+def fetch_image(url, session, limiter, processor, cache=None):
+    '''processed image behind url, served from the cache as long as it is fresh or its ETag matches'''
+    entry = cache.get(url, processor.variant) if cache is not None else None
+    if entry is not None and entry.fresh(cache.ttl):
+        processor.record(url, entry.size, entry.data)
+        return entry.data
+    headers = {"If-None-Match": entry.etag} if entry is not None and entry.etag else None
+    response = download(url, session, limiter, headers)
+    if response.status_code == 304 and entry is not None:
+        cache.touch(url, processor.variant, entry)
+        processor.record(url, entry.size, entry.data)
+        return entry.data
+    data = processor.process(response.content)
+    if cache is not None:
+        cache.put(url, processor.variant, response.headers.get("ETag"), response.content, data)
+    processor.record(url, len(response.content), data)
+    return data
+
+
+def fetch_images(urls, session=None, max_workers=MAX_WORKERS, limiter=None, cache=None, processor=None, progress=None,
+                 errors=None):
+    '''download all urls concurrently, returns a dict mapping each url to its processed image.
+    progress is called with the number of images fetched so far after every image.
+    the first failed url raises, unless errors is a dict: failed urls are then left out of the result
+    and mapped to their exception in errors'''
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+    session = session or get_session()
+    limiter = limiter or HostLimiter()
+    processor = processor or ImageProcessor()
+    fetched = [0]
+    lock = threading.Lock()
+
+    def fetch(url):
+        try:
+            data = fetch_image(url, session, limiter, processor, cache)
+        except Exception as e:  # pylint: disable=W0703
+            if errors is None:
+                raise
+            errors[url] = e
+            data = None
+        if progress is not None:
+            with lock:
+                fetched[0] += 1
+                progress(fetched[0])
+        return data
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as pool:
+        contents = pool.map(fetch, urls)
+        return {url: data for url, data in zip(urls, contents) if data is not None}
@@ -0,0 +1,127 @@
+'''streaming ingestion of export requests.
+
+a request body is parsed event by event with ijson instead of json.loads, only the fields the export
+reads end up in memory: the title and _id of raw_survey and the fields of its questions listed in
+QUESTION_FIELDS. the quotas, filter exits, panel metadata and whatever else the frontend sends along are
+skipped while parsing. the questions are still read into one (compact) list, filters can point at later
+questions and the cache key covers all of them.
+'''
+import io
+import sys
+import ijson
+
+CHUNK_SIZE = 64 * 1024
+
+# fields read by model.normalize and images.collect_image_urls. a field maps to the fields of its
+# items (for lists of objects) or to None to keep its value as it is
+ITEM_FIELDS = {"text": None, "filterId": None, "random": None, "imageUrl": None}
+QUESTION_FIELDS = {"hideForCompany": None, "qtype": None, "text": None, "help": None, "media": None,
+                   "multioptions": None, "maxOptions": None, "minOptions": None, "allowCustomText": None,
+                   "customTextName": None, "infoText": None, "filterRequirements": None,
+                   "filterNotRequirements": None, "answers": ITEM_FIELDS, "rows": ITEM_FIELDS, "key": ITEM_FIELDS}
+SURVEY_FIELDS = {"_id": None, "title": None, "questions": QUESTION_FIELDS}
+# "*": fields not listed are kept as well
+REQUEST_FIELDS = {"raw_survey": SURVEY_FIELDS, "*": None}
+BATCH_FIELDS = {"surveys": REQUEST_FIELDS, "*": None}
+
+
+class _TextReader:
+    '''binary file over a str, encodes it chunk by chunk instead of all at once'''
+
+    def __init__(self, text):
+        self._text = text
+        self._position = 0
+
+    def read(self, size=-1):
+        size = CHUNK_SIZE if size is None or size < 0 else size
+        chunk = self._text[self._position:self._position + size]
+        self._position += size
+        return chunk.encode("utf-8")
+
+
+def _subfields(fields, key):
+    '''(keep, fields of the value) of key within an object with the given fields'''
+    if fields is None:
+        return True, None
+    if key in fields:
+        return True, fields[key]
+    if "*" in fields:
+        return True, fields["*"]
+    return False, None
+
+
+def _skip(events, event):
+    if event not in ("start_map", "start_array"):
+        return
+    depth = 1
+    for event, _ in events:
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+            if depth == 0:
+                return
+
+
+def _items(events, fields):
+    '''the items of the array whose start_array was just read, one at a time'''
+    for event, value in events:
+        if event == "end_array":
+            return
+        yield _value(events, event, value, fields)
+
+
+def _value(events, event, value, fields):
+    '''the JSON value starting with (event, value), objects only keep the given fields'''
+    if event == "start_map":
+        result = {}
+        for event, key in events:
+            if event == "end_map":
+                return result
+            event, value = next(events)
+            keep, subfields = _subfields(fields, key)
+            if keep:
+                # ijson creates a new str for every key, json.loads shares them
+                result[sys.intern(key)] = _value(events, event, value, subfields)
+            else:
+                _skip(events, event)
+    if event == "start_array":
+        return list(_items(events, fields))
+    return value
+
+
+def _events(source):
+    if isinstance(source, str):
+        source = _TextReader(source)
+    elif isinstance(source, bytes):
+        source = io.BytesIO(source)
+    # floats instead of Decimal, the request is serialized again for the cache key and the job store
+    return ijson.basic_parse(source, use_float=True)
+
+
+def parse(source, fields):
+    '''the JSON document in source (str, bytes or binary file) with the objects reduced to fields'''
+    events = _events(source)
+    event, value = next(events)
+    return _value(events, event, value, fields)
+
+
+def compact(value, fields):
+    '''an already parsed value reduced to fields, the same as parse() would have returned'''
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            keep, subfields = _subfields(fields, key)
+            if keep:
+                result[key] = compact(item, subfields)
+        return result
+    if isinstance(value, list):
+        return [compact(item, fields) for item in value]
+    return value
+
+
+def read_request(body, fields=REQUEST_FIELDS):
+    '''request of an API body (JSON text) or of a direct invocation (dict), compacted to fields'''
+    if isinstance(body, dict):
+        return compact(body, fields)
+    return parse(body, fields)
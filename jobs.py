@@ -0,0 +1,76 @@
+'''asynchronous export jobs: state and request payload in S3, work items in SQS'''
+import json
+import time
+import uuid
+
+PROGRESS_INTERVAL = 2  # seconds between two progress writes of a running job
+
+
+class JobStore:
+    '''keeps the request and the state of every job under jobs/<job id>/ in the export bucket'''
+
+    def __init__(self, s3, bucket, prefix="jobs/"):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _put(self, job_id, name, payload):
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + job_id + "/" + name,
+                           Body=json.dumps(payload).encode(), ContentType="application/json")
+
+    def _get(self, job_id, name):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + job_id + "/" + name)
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+
+    def create(self, data):
+        '''store the request of a new job, returns its id'''
+        job_id = uuid.uuid4().hex
+        self._put(job_id, "request.json", data)
+        self.save(job_id, {"status": "queued", "created": time.time()})
+        return job_id
+
+    def request(self, job_id):
+        return self._get(job_id, "request.json")
+
+    def state(self, job_id):
+        '''state of the job or None for unknown ids'''
+        return self._get(job_id, "state.json")
+
+    def save(self, job_id, state):
+        self._put(job_id, "state.json", state)
+
+
+class SQSQueue:
+    '''hands job ids to the worker function'''
+
+    def __init__(self, sqs, queue_url):
+        self.sqs = sqs
+        self.queue_url = queue_url
+
+    def send(self, job_id):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps({"job_id": job_id}))
+
+
+def job_ids(event):
+    '''job ids of an SQS event'''
+    return [json.loads(record["body"])["job_id"] for record in event["Records"]]
+
+
+class JobProgress:
+    '''progress callback for go(), writes the counters to the job state at most every PROGRESS_INTERVAL seconds'''
+
+    def __init__(self, store, job_id, state):
+        self.store = store
+        self.job_id = job_id
+        self.state = state
+        self._last_write = 0
+
+    def __call__(self, **counters):
+        self.state.update(counters)
+        now = time.monotonic()
+        if now - self._last_write >= PROGRESS_INTERVAL:
+            self._last_write = now
+            self.store.save(self.job_id, self.state)
@@ -0,0 +1,104 @@
+'''per phase timing and memory instrumentation of an export.
+
+a Metrics object collects the duration of the phases (spans), counters like image bytes or the
+document size and the peak memory of one export, emit() logs all of it as one line in the CloudWatch
+embedded metric format. instrumentation is off by default, go() and export() then get NULL_METRICS
+whose calls do nothing. see create_metrics for how to switch it on.
+'''
+import json
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+NAMESPACE = "SurveyExport"
+_NULL_SPAN = nullcontext()
+
+
+def peak_rss_mb():
+    '''peak resident set size of the process so far (ru_maxrss is in KB on Linux)'''
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class Metrics:
+    '''spans and counters of one export, handler is the dimension of the emitted metrics.
+    with trace_memory the peak of the python allocations is traced as well, tracemalloc slows the export down'''
+    enabled = True
+
+    def __init__(self, handler, trace_memory=False):
+        self.handler = handler
+        self.phases = {}
+        self.counters = {}
+        self.trace_memory = trace_memory and not tracemalloc.is_tracing()
+        if self.trace_memory:
+            tracemalloc.start()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name):
+        '''time the phase name, the peak RSS is sampled when it ends'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = {"ms": round(1000 * (time.perf_counter() - start), 2), "peak_rss_mb": peak_rss_mb()}
+
+    def record(self, **counters):
+        self.counters.update(counters)
+
+    def summary(self):
+        '''phases, counters and memory as a dict, stops the memory tracing'''
+        summary = {"total_ms": round(1000 * (time.perf_counter() - self._start), 2),
+                   "peak_rss_mb": peak_rss_mb(),
+                   "phases": self.phases}
+        if self.trace_memory:
+            summary["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+            tracemalloc.stop()
+            self.trace_memory = False
+        summary.update(self.counters)
+        return summary
+
+    def emit(self, summary=None):
+        '''log the summary as embedded metric format line. every phase becomes a metric "<phase>_ms",
+        counters are metrics when their name ends with _ms, _mb, _bytes or _count'''
+        summary = summary or self.summary()
+        line = {name + "_ms": phase["ms"] for name, phase in summary["phases"].items()}
+        line.update(summary)
+        metrics = [{"Name": name, "Unit": "Milliseconds"} for name in line if name.endswith("_ms")]
+        metrics += [{"Name": name, "Unit": "Megabytes"} for name in line if name.endswith("_mb")]
+        metrics += [{"Name": name, "Unit": "Bytes"} for name in line if name.endswith("_bytes")]
+        metrics += [{"Name": name, "Unit": "Count"} for name in line if name.endswith("_count")]
+        line["Handler"] = self.handler
+        line["_aws"] = {"Timestamp": int(time.time() * 1000),
+                        "CloudWatchMetrics": [{"Namespace": NAMESPACE, "Dimensions": [["Handler"]],
+                                               "Metrics": metrics}]}
+        print(json.dumps(line))
+        return summary
+
+
+class NullMetrics:
+    '''instrumentation switched off'''
+    enabled = False
+
+    def span(self, name):  # pylint: disable=W0613
+        return _NULL_SPAN
+
+    def record(self, **counters):
+        pass
+
+    def summary(self):
+        return None
+
+    def emit(self, summary=None):
+        return None
+
+
+NULL_METRICS = NullMetrics()
+
+
+def create_metrics(handler, setting, force=False):
+    '''Metrics for the setting of the environment variable EXPORT_METRICS: empty or "0" is off (unless forced),
+    "tracemalloc" also traces the python allocations, everything else switches on spans and RSS'''
+    if not force and setting in (None, "", "0"):
+        return NULL_METRICS
+    return Metrics(handler, trace_memory=setting == "tracemalloc")
@@ -0,0 +1,185 @@
+'''normalization of raw_survey into the compact model the renderers work on.
+
+normalize() reads the raw JSON once and resolves everything that does not depend on the document:
+numbering, randomization, question type labels in both languages, filter references and the images.
+'''
+from images import collect_image_urls
+
+# labels of the question types
+QTYPES_EN = {"mc": "Multiple Choice",
+             "freetext": "Open question",
+             "info": "Info box",
+             "matrix": "Matrix",
+             "likert": "Likert",
+             "imagecloud": "Multiple Choice (with images)",
+             "image": "Multiple Choice (with images and text)",
+             "numericslider": "Numeric slider / NPS",
+             "ranking": "Ranking",
+             "starslider": "Stars",
+             "propertyslider": "Preference slider",
+             "number": "Number (Open entry)",
+             "heatmap": "Heatmap",
+             "videoplay": "Audio/Video",
+             "photocaptur": "Take photo"}
+
+QTYPES_DE = {"mc": "Multiple Choice",
+             "freetext": "Offene Frage",
+             "info": "Infobox",
+             "matrix": "Matrix",
+             "likert": "Likert",
+             "numericslider": "Numerischer Slider / NPS",
+             "ranking": "Ranking",
+             "starslider": "Stars",
+             "propertyslider": "Präferenz-Slider",
+             "number": "Zahl (Freie Eingabe)",
+             "heatmap": "Heatmap",
+             "videoplay": "Audio/Video",
+             "photocaptur": "Fotoaufnahme"}
+
+INFO_QTYPES = ("info", "videoplay")
+
+
+class Item:
+    '''an answer, matrix row or likert key item. not_randomized is only meaningful within randomized lists'''
+    __slots__ = ("letter", "text", "not_randomized")
+
+    def __init__(self, letter, text, not_randomized=False):
+        self.letter = letter
+        self.text = text
+        self.not_randomized = not_randomized
+
+
+class Question:
+    '''a question (or info box) as it is shown in the export'''
+    __slots__ = ("label", "is_info", "qtype", "text", "help", "media", "answers", "answers_random", "custom_text",
+                 "info_text", "answer_images", "rows", "rows_random", "rows_not_randomized", "key",
+                 "type_label_en", "type_label_de", "max_options", "min_options", "has_filters", "filters")
+
+    def __init__(self, label, is_info, qtype, text):
+        self.label = label  # "F3" or "Info 2"
+        self.is_info = is_info
+        self.qtype = qtype
+        self.text = text
+        self.help = None
+        self.media = None
+        self.answers = []
+        self.answers_random = False
+        self.custom_text = None  # label of the free text answer
+        self.info_text = None
+        self.answer_images = []
+        self.rows = []
+        self.rows_random = False
+        self.rows_not_randomized = False  # some rows are excluded from randomization
+        self.key = []
+        self.type_label_en = None
+        self.type_label_de = None
+        self.max_options = None
+        self.min_options = None
+        self.has_filters = False
+        self.filters = []  # "IF F3A" / "IF NOT F3A"
+
+    def type_label(self, english_lang):
+        return self.type_label_en if english_lang else self.type_label_de
+
+
+class Survey:
+    __slots__ = ("id", "title", "questions", "image_urls")
+
+    def __init__(self, survey_id, title, questions, image_urls):
+        self.id = survey_id
+        self.title = title
+        self.questions = questions
+        self.image_urls = image_urls
+
+
+def build_filter_index(questions):
+    '''map every filterId to the (question no, answer letter, answers_only) of the answers and key items carrying it.
+    key items of questions that also have answers are flagged answers_only, "Filter IF" skips them'''
+    filter_index = {}
+    for l, question in enumerate(questions):
+        for m, answer in enumerate(question['answers']):
+            if "filterId" in answer:
+                filter_index.setdefault(str(answer["filterId"]), []).append((1 + l, 65 + m, False))
+        for n, item in enumerate(question['key']):
+            if "filterId" in item:
+                filter_index.setdefault(str(item["filterId"]), []).append((1 + l, 65 + n, question['answers'] != []))
+    return filter_index
+
+
+def type_label(raw, labels):
+    if raw['qtype'] != "mc":
+        return labels.get(raw['qtype'])
+    if 'multioptions' in raw:
+        return "Multiple Choice" if raw['multioptions'] else "Single Choice"
+    return None
+
+
+def filter_lines(raw, filter_index):
+    lines = []
+    if raw["filterRequirements"] != []:
+        for filter_id in raw["filterRequirements"]:
+            for question_no, letter, answers_only in filter_index.get(str(filter_id), ()):
+                if not answers_only:
+                    lines.append("IF F" + str(question_no) + chr(letter))
+    elif raw["filterNotRequirements"] != []:
+        for filter_id in raw["filterNotRequirements"]:
+            for question_no, letter, _ in filter_index.get(str(filter_id), ()):
+                lines.append("IF NOT F" + str(question_no) + chr(letter))
+    return lines
+
+
+def normalize_question(raw, label, filter_index):
+    question = Question(label, raw['qtype'] in INFO_QTYPES, raw['qtype'], raw['text'])
+    if "help" in raw:
+        question.help = str(raw['help'])
+    if "media" in raw:
+        question.media = str(raw['media'])
+
+    # answers. within randomized answers, the first answer excluded from randomization and all after it are marked
+    question.answers_random = any(answer.get("random") for answer in raw['answers'])
+    not_randomized = False
+    for j, answer in enumerate(raw['answers']):
+        if question.answers_random and not answer.get("random"):
+            not_randomized = True
+        question.answers.append(Item(chr(65 + j), answer['text'], not_randomized))
+        if "imageUrl" in answer:
+            question.answer_images.append(str(answer['imageUrl']))
+    if raw.get("allowCustomText") == True and "customTextName" in raw:  # pylint: disable=C0121
+        question.custom_text = str(raw["customTextName"])
+    if question.is_info and "infoText" in raw:
+        question.info_text = str(raw['infoText'])
+
+    # matrix rows, marked as a whole when some of them are excluded from randomization
+    question.rows_random = any(row.get("random") == True for row in raw['rows'])  # pylint: disable=C0121
+    question.rows_not_randomized = question.rows_random and not all(row.get("random") for row in raw['rows'])
+    question.rows = [Item(chr(65 + k), row['text']) for k, row in enumerate(raw['rows'])]
+    question.key = [Item(chr(65 + k), item['text']) for k, item in enumerate(raw['key'])]
+
+    question.type_label_en = type_label(raw, QTYPES_EN)
+    question.type_label_de = type_label(raw, QTYPES_DE)
+    if "maxOptions" in raw:
+        question.max_options = str(raw['maxOptions'])
+    if "minOptions" in raw:
+        question.min_options = str(raw['minOptions'])
+    question.has_filters = raw["filterRequirements"] != [] or raw["filterNotRequirements"] != []
+    question.filters = filter_lines(raw, filter_index)
+    return question
+
+
+def normalize(survey_raw):
+    '''the Survey model of a raw_survey, hidden questions are left out'''
+    filter_index = build_filter_index(survey_raw['questions'])
+    questions = []
+    info_no = 1
+    question_no = 1
+    for raw in survey_raw['questions']:
+        if raw['hideForCompany']:
+            continue
+        if raw['qtype'] in INFO_QTYPES:
+            label = "Info " + str(info_no)
+            info_no += 1
+        else:
+            label = "F" + str(question_no)
+            question_no += 1
+        questions.append(normalize_question(raw, label, filter_index))
+    return Survey(survey_raw.get('_id'), survey_raw['title'], questions, collect_image_urls(survey_raw['questions']))
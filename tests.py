@@ -2,8 +2,23 @@
 
 
 import os
+import app
 from app import go
+from model import build_filter_index, normalize
 import json
+import zipfile
+from io import BytesIO
+import requests
+import boto3
+import pytest
+from moto import mock_s3, mock_sqs
+import images
+import batch
+import benchmarks
+import ingest
+import formats
+from imagecache import ImageCache, DirectoryStore
+from PIL import Image
 
 
 def test_go():
@@ -11,10 +26,347 @@ def test_go():
     for f in os.listdir("./events"):
         data = open("./events/" + f)
         inp = json.load(data)
-        go(inp["body"])
-        assert "survey_export.docx" in os.listdir("/tmp")
-        os.remove("/tmp/survey_export.docx")
+        with go(inp["body"]) as output:
+            assert zipfile.is_zipfile(output)
 
 
 
 test_go()
+
+
+class FakeResponse:
+    '''minimal stand-in for requests.Response'''
+    def __init__(self, status_code, content=b""):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+class FakeSession:
+    '''serves every url with its own name, failing the first attempt for flaky urls'''
+    def __init__(self):
+        self.calls = []
+
+    def get(self, url, timeout=None, headers=None):
+        self.calls.append(url)
+        if "flaky" in url and self.calls.count(url) == 1:
+            return FakeResponse(503)
+        if headers and headers.get("If-None-Match") == "v1":
+            return FakeResponse(304)
+        response = FakeResponse(200, url.encode())
+        response.headers["ETag"] = "v1"
+        return response
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    '''moto S3 with the export bucket, app creates its client within the mock'''
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(app, "_s3", None)
+    with mock_s3():
+        boto3.client("s3").create_bucket(Bucket=app.BUCKET)
+        yield app.BUCKET
+
+
+def test_fetch_images(monkeypatch):
+    '''images are fetched once per url, transient errors are retried'''
+    monkeypatch.setattr(images, "BACKOFF", 0)
+    questions = [
+        {"hideForCompany": False, "media": "http://a/q1", "answers": [{"imageUrl": "http://a/flaky"}]},
+        {"hideForCompany": True, "media": "http://a/hidden", "answers": []},
+        {"hideForCompany": False, "answers": [{"imageUrl": "http://b/q1"}, {"imageUrl": "http://a/q1"}]},
+    ]
+    urls = images.collect_image_urls(questions)
+    assert urls == ["http://a/q1", "http://a/flaky", "http://b/q1"]
+    session = FakeSession()
+    fetched = images.fetch_images(urls, session=session)
+    assert fetched == {url: url.encode() for url in urls}
+    assert sorted(session.calls) == sorted(urls + ["http://a/flaky"])
+
+
+def test_build_filter_index():
+    '''filterIds resolve to question number and answer letter, key items of questions with answers are flagged'''
+    questions = [
+        {"answers": [{"filterId": "a1"}, {"text": "no filter"}, {"filterId": "a3"}], "key": [{"filterId": "k1"}]},
+        {"answers": [], "key": [{"filterId": "k2"}, {"filterId": "a1"}]},
+    ]
+    assert build_filter_index(questions) == {
+        "a1": [(1, 65, False), (2, 66, False)],
+        "a3": [(1, 67, False)],
+        "k1": [(1, 65, True)],
+        "k2": [(2, 65, False)],
+    }
+
+
+def test_engines():
+    '''the WordprocessingML engine writes the same document as the python-docx engine'''
+    with open("./events/624ebad9f436a20014c7e8b7.json") as f:
+        inp = json.load(f)["body"]
+    inp["raw_survey"]["questions"][1]["help"] = " tabs\tand\nbreaks & <escapes> "
+    documents = []
+    for engine in ("docx", "xml"):
+        with go(dict(inp, engine=engine)) as output:
+            documents.append(zipfile.ZipFile(output).read("word/document.xml"))
+    assert documents[0] == documents[1]
+
+
+def test_normalize():
+    '''numbering skips hidden questions, randomization and free text answers are resolved per question'''
+    def question(qtype, **fields):
+        raw = {"hideForCompany": False, "qtype": qtype, "text": qtype, "answers": [], "rows": [], "key": [],
+               "filterRequirements": [], "filterNotRequirements": []}
+        raw.update(fields)
+        return raw
+    answers = [{"text": "a", "random": True, "filterId": "f1"}, {"text": "b", "random": False}, {"text": "c", "random": True}]
+    survey = normalize({"_id": "s", "title": "t", "questions": [
+        question("mc", answers=answers, allowCustomText=True, customTextName="Other", multioptions=True),
+        question("info", hideForCompany=True),
+        question("info", infoText="hello"),
+        question("freetext", filterNotRequirements=["f1"]),
+    ]})
+    first, info, freetext = survey.questions
+    assert [q.label for q in survey.questions] == ["F1", "Info 1", "F2"]
+    assert first.answers_random and [a.not_randomized for a in first.answers] == [False, True, True]
+    assert first.custom_text == "Other"
+    assert first.type_label(True) == "Multiple Choice"
+    assert info.info_text == "hello"
+    assert freetext.type_label(False) == "Offene Frage"
+    assert freetext.has_filters and freetext.filters == ["IF NOT F1A"]
+
+
+def test_lambda_handler(s3_bucket, monkeypatch):
+    '''the export is uploaded to S3 and reused for unchanged surveys, the client is kept for warm invocations'''
+    with open("./events/624ebad9f436a20014c7e8b7.json") as f:
+        event = json.load(f)
+    response = app.lambda_handler(event, None)
+    assert response["statusCode"] == 200
+    key = app.export_key(event["body"])
+    assert key.startswith("624ebad9f436a20014c7e8b7/")
+    assert key in response["body"]
+    s3 = app.get_s3()
+    obj = s3.get_object(Bucket=app.BUCKET, Key=key)
+    assert zipfile.is_zipfile(BytesIO(obj["Body"].read()))
+
+    # unchanged survey: served from S3 without rendering
+    rendered = []
+    monkeypatch.setattr(app, "render", lambda *args, **kwargs: rendered.append(args))
+    event["body"]["raw_survey"]["userCounter"] = 1000
+    assert key in app.lambda_handler(event, None)["body"]
+    assert not rendered
+    assert app.get_s3() is s3
+
+    event["body"]["raw_survey"]["questions"][0]["text"] = "changed"
+    assert app.export_key(event["body"]) != key
+
+
+@mock_sqs
+def test_async_export(s3_bucket, monkeypatch):
+    '''asynchronous exports return a job id, the worker renders them and the status returns the URL'''
+    monkeypatch.setattr(app, "_queue", None)
+    sqs = boto3.client("sqs")
+    queue_url = sqs.create_queue(QueueName="export-jobs")["QueueUrl"]
+    monkeypatch.setenv("EXPORT_QUEUE_URL", queue_url)
+    with open("./events/624ebad9f436a20014c7e8b7.json") as f:
+        event = json.load(f)
+    event["body"]["async"] = True  # a JSON boolean, the other flags are strings
+
+    response = app.lambda_handler(event, None)
+    assert response["statusCode"] == 202
+    job_id = json.loads(response["body"])["job_id"]
+    status = {"httpMethod": "GET", "pathParameters": {"job_id": job_id}}
+    assert json.loads(app.lambda_handler(status, None)["body"])["status"] == "queued"
+
+    messages = sqs.receive_message(QueueUrl=queue_url)["Messages"]
+    app.job_handler({"Records": [{"body": message["Body"]} for message in messages]}, None)
+    state = json.loads(app.lambda_handler(status, None)["body"])
+    assert state["status"] == "done"
+    assert state["questions_rendered"] == state["questions_total"] > 0
+    assert app.export_key(event["body"]) in state["url"]
+
+    status["pathParameters"]["job_id"] = "unknown"
+    assert app.lambda_handler(status, None)["statusCode"] == 404
+
+
+def test_map_in_processes():
+    '''results keep the order of the items'''
+    assert batch.map_in_processes(len, ["a", "bb", "ccc", "dddd", "eeeee"], 2) == [1, 2, 3, 4, 5]
+
+
+def test_batch_handler(s3_bucket):
+    '''all surveys of a batch are exported, with a manifest of URLs and timings and a zip'''
+    with open("./events/624ebad9f436a20014c7e8b7.json") as f:
+        survey = json.load(f)["body"]
+    surveys = [survey, dict(survey, english_lang="true")]
+    response = batch.batch_handler({"body": {"surveys": surveys, "zip": "true", "workers": 1}}, None)
+    manifest = json.loads(response["body"])
+    assert [result["cached"] for result in manifest["surveys"]] == [False, False]
+    assert all("url" in result and result["seconds"] >= 0 for result in manifest["surveys"])
+    assert "batches/" in manifest["zip"]
+
+
+def test_image_cache(tmp_path, monkeypatch):
+    '''cached images are reused, stale ones revalidated with their ETag, the LRU keeps to its budget'''
+    cache = ImageCache(budget=20, store=DirectoryStore(str(tmp_path)))
+    session = FakeSession()
+    assert images.fetch_images(["http://a/1"], session=session, cache=cache) == {"http://a/1": b"http://a/1"}
+    assert images.fetch_images(["http://a/1"], session=session, cache=cache) == {"http://a/1": b"http://a/1"}
+    assert session.calls == ["http://a/1"]
+    assert not list(tmp_path.rglob("*.tmp"))
+
+    # a new container only has the persistent tier, stale entries are revalidated
+    cache = ImageCache(budget=20, store=DirectoryStore(str(tmp_path)), ttl=0)
+    monkeypatch.setattr(session, "get", lambda url, timeout=None, headers=None: FakeResponse(304))
+    assert images.fetch_images(["http://a/1"], session=session, cache=cache) == {"http://a/1": b"http://a/1"}
+
+    images.fetch_images(["http://a/2", "http://a/3"], session=FakeSession(), cache=cache)
+    assert cache.size == 20
+
+
+def test_image_processor():
+    '''images are downscaled to the display width, identical images are embedded once'''
+    photo = BytesIO()
+    Image.effect_noise((2000, 1000), 40).convert("RGB").save(photo, "JPEG")
+    photo = photo.getvalue()
+    processor = images.ImageProcessor(dpi=150)
+    for url in ("http://a/1", "http://b/1"):
+        processor.record(url, len(photo), processor.process(photo))
+    assert Image.open(BytesIO(processor.process(photo))).size == (300, 150)
+    report = processor.report()
+    assert report["images"] == 2 and report["embedded_images"] == 1
+    assert report["bytes_saved"] > len(photo)
+
+
+def test_benchmark_suite():
+    '''the synthetic survey has the requested images, the suite measures go() with them served locally'''
+    survey = benchmarks.synthetic_survey(5, n_answers=2, n_images=8)
+    assert len(images.collect_image_urls(survey["questions"])) == 8
+    scenario = {"name": "tiny", "questions": 5, "answers": 2, "rows": 1, "key": 1, "filter_density": 0.5,
+                "images": 3, "latency": 0.01}
+    report = benchmarks.run_suite([scenario], targets=[("go", benchmarks.run_go)])
+    result, cold_start = report["results"]
+    assert result["output_bytes"] > 0 and result["peak_rss_mb"] > 0 and result["wall_s"] > 0
+    assert cold_start["target"] == "import app" and cold_start["wall_s"] > 0
+
+
+def test_export_metrics(s3_bucket, capsys):
+    '''debug requests get the phase timings in a header, the same summary is logged as embedded metrics'''
+    with open("./events/624ebad9f436a20014c7e8b7.json") as f:
+        event = json.load(f)
+    assert "X-Export-Metrics" not in app.lambda_handler(event, None)["headers"]
+    assert capsys.readouterr().out == ""
+
+    event["body"]["debug"] = "true"
+    event["body"]["english_lang"] = "true"
+    response = app.lambda_handler(event, None)
+    summary = json.loads(response["headers"]["X-Export-Metrics"])
+    assert set(summary["phases"]) == {"cache_check", "normalize", "rows", "save", "upload"}
+    assert summary["document_bytes"] > 0 and summary["peak_rss_mb"] > 0 and not summary["cached"]
+    line = json.loads(capsys.readouterr().out)
+    assert line["save_ms"] == summary["phases"]["save"]["ms"]
+    assert {"Name": "document_bytes", "Unit": "Bytes"} in line["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+
+
+def test_incremental_export(tmp_path, monkeypatch):
+    '''only changed questions and rows whose filter labels moved are rendered again, the document stays the same'''
+    monkeypatch.setenv("FRAGMENT_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "_fragment_cache", None)
+    rendered = []
+    render_question = app.render_question
+    monkeypatch.setattr(app, "render_question", lambda cells, question, *args: rendered.append(question.label)
+                        or render_question(cells, question, *args))
+
+    def document_xml(data):
+        with go(data) as output, zipfile.ZipFile(output) as docx:
+            return docx.read("word/document.xml")
+
+    data = {"raw_survey": benchmarks.synthetic_survey(20, filter_density=1), "incl_images": "false",
+            "english_lang": "true"}
+    document_xml(data)
+    assert len(rendered) == 20
+    rendered.clear()
+    data["raw_survey"]["questions"][4]["text"] = "Edited question"
+    assert document_xml(data) == document_xml(dict(data, incremental="false"))
+    assert rendered[0] == "F5" and len(rendered) == 1 + 20
+
+    # removing a question renumbers the rows after it and moves the filter labels pointing at them
+    rendered.clear()
+    del data["raw_survey"]["questions"][17]
+    document_xml(data)
+    assert rendered == ["F18", "F19"]
+
+    # the rows an export without images cached are not reused by an export with images
+    picture = BytesIO()
+    Image.new("RGB", (10, 10)).save(picture, "PNG")
+    monkeypatch.setattr(app, "fetch_images", lambda urls, **kwargs: {url: picture.getvalue() for url in urls})
+    data = {"raw_survey": benchmarks.synthetic_survey(5, n_images=2), "incl_images": "false", "english_lang": "true"}
+    document_xml(data)
+    data["incl_images"] = "true"
+    xml = document_xml(data)
+    assert xml.count(b"<w:drawing>") == 2 and xml == document_xml(dict(data, incremental="false"))
+
+
+def test_read_request():
+    '''streamed bodies keep only the rendered fields, the same as already parsed ones, and give the same cache key'''
+    with open("./events/624ebad9f436a20014c7e8b7.json") as f:
+        body = json.load(f)["body"]
+    body["image_dpi"] = 120
+    body["raw_survey"]["questions"][0]["maxOptions"] = 2.5
+    data = ingest.read_request(json.dumps(body))
+    assert data == ingest.read_request(body)
+    assert set(data) == {"raw_survey", "incl_images", "english_lang", "image_dpi"}
+    assert set(data["raw_survey"]) == {"_id", "title", "questions"}
+    first = data["raw_survey"]["questions"][0]
+    assert "displayGroup" not in first and "_id" not in first["answers"][0] and first["maxOptions"] == 2.5
+    assert ingest.parse(json.dumps(body).encode(), ingest.REQUEST_FIELDS) == data
+    assert app.export_key(data) == app.export_key(body)
+
+
+def test_output_formats(s3_bucket, monkeypatch):
+    '''several formats in one request, each uploaded under the survey id, the text formats without python-docx'''
+    with open("./events/62613d1894a79e001403cb85.json") as f:
+        event = json.load(f)
+    event["body"]["output_format"] = "csv, html,markdown"
+    monkeypatch.setattr(app, "render_docx", None)
+    urls = json.loads(app.lambda_handler(event, None)["body"])
+    assert list(urls) == ["csv", "html", "markdown"]
+    s3 = app.get_s3()
+    objects = {}
+    for output_format in urls:
+        key = app.export_key(event["body"], output_format)
+        assert key.startswith("62613d1894a79e001403cb85/") and key in urls[output_format]
+        obj = s3.get_object(Bucket=app.BUCKET, Key=key)
+        objects[output_format] = obj["Body"].read().decode()
+        assert obj["ContentType"] == formats.FORMATS[output_format][1]
+    assert objects["csv"].splitlines()[1].startswith("F1,question,,Welches dieser Verkehrsmittel")
+    assert "F2,answer,A,Mit meinem eigenen Auto" in objects["csv"]
+    assert "<td><p><b>F1</b></p></td>" in objects["html"] and "IF F1A" in objects["html"]
+    assert "## F2" in objects["markdown"] and "H: Keins davon (not randomized)" in objects["markdown"]
+
+    event["body"]["output_format"] = "pdf"
+    assert app.lambda_handler(event, None)["statusCode"] == 400
+
+
+def test_cold_start_imports():
+    '''python-docx, requests and Pillow are loaded by the exports that need them, not by the cold start'''
+    times = benchmarks.import_times("app")
+    assert "app" in times and "boto3" in times
+    assert not {"docx", "lxml", "requests", "PIL"} & set(times)
+
+
+def test_batch_image_error(s3_bucket, monkeypatch):
+    '''an image that cannot be fetched fails its survey only, the rest of the batch is exported'''
+    monkeypatch.setattr(images, "BACKOFF", 0)
+    with open("./events/624ebad9f436a20014c7e8b7.json") as f:
+        survey = json.load(f)["body"]
+    broken = {"raw_survey": benchmarks.synthetic_survey(3, n_images=1, image_url="http://127.0.0.1:1/"),
+              "incl_images": "true", "english_lang": "true"}
+    response = batch.batch_handler({"body": {"surveys": [survey, broken], "workers": 1}}, None)
+    good, failed = json.loads(response["body"])["surveys"]
+    assert "url" in good and "error" not in good
+    assert "error" in failed and "url" not in failed
@@ -0,0 +1,150 @@
+'''fast rendering engine for the question table.
+
+instead of building every paragraph and run through python-docx and its lxml proxies, the rows are
+written as WordprocessingML text and parsed in bulk, CHUNK_ROWS rows at a time. the cells offer the
+part of the python-docx cell API that render_question uses, so both engines share the layout code
+and produce the same document.
+'''
+import re
+from xml.sax.saxutils import escape
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from docx.shared import Emu
+
+CHUNK_ROWS = 200
+_SPECIAL_CHARS = re.compile(r"([\t\r\n])")
+
+INLINE_XML = (
+    '<w:drawing><wp:inline xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<wp:extent cx="%(cx)d" cy="%(cy)d"/><wp:docPr id="%(id)d" name="Picture %(id)d"/>'
+    '<wp:cNvGraphicFramePr><a:graphicFrameLocks noChangeAspect="1"/></wp:cNvGraphicFramePr>'
+    '<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<pic:pic><pic:nvPicPr><pic:cNvPr id="0" name=%(filename)s/><pic:cNvPicPr/></pic:nvPicPr>'
+    '<pic:blipFill><a:blip r:embed="%(rId)s"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+    '<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="%(cx)d" cy="%(cy)d"/></a:xfrm>'
+    '<a:prstGeom prst="rect"/></pic:spPr></pic:pic></a:graphicData></a:graphic></wp:inline></w:drawing>')
+
+
+def text_xml(text):
+    '''run content of text the way python-docx writes it: tabs and line breaks become elements'''
+    parts = []
+    for piece in _SPECIAL_CHARS.split(text):
+        if piece == "\t":
+            parts.append("<w:tab/>")
+        elif piece in ("\r", "\n"):
+            parts.append("<w:br/>")
+        elif len(piece.strip()) < len(piece):
+            parts.append('<w:t xml:space="preserve">' + escape(piece) + '</w:t>')
+        elif piece:
+            parts.append('<w:t>' + escape(piece) + '</w:t>')
+    return "".join(parts)
+
+
+class Run:
+    __slots__ = ("bold", "_content", "_writer")
+
+    def __init__(self, writer, text):
+        self.bold = False
+        self._content = [text_xml(text)] if text else []
+        self._writer = writer
+
+    def add_break(self):
+        self._content.append("<w:br/>")
+
+    def add_picture(self, image_descriptor, width):
+        self._content.append(self._writer.picture_xml(image_descriptor, width))
+
+    def xml(self):
+        if not self.bold and not self._content:
+            return "<w:r/>"
+        return "<w:r>" + ("<w:rPr><w:b/></w:rPr>" if self.bold else "") + "".join(self._content) + "</w:r>"
+
+
+class Paragraph:
+    __slots__ = ("_runs", "_writer")
+
+    def __init__(self, writer):
+        self._runs = []
+        self._writer = writer
+
+    def add_run(self, text=""):
+        run = Run(self._writer, text)
+        self._runs.append(run)
+        return run
+
+    def xml(self):
+        if not self._runs:
+            return "<w:p/>"
+        return "<w:p>" + "".join(run.xml() for run in self._runs) + "</w:p>"
+
+
+class Cell:
+    __slots__ = ("paragraphs", "_writer")
+
+    def __init__(self, writer):
+        self.paragraphs = [Paragraph(writer)]
+        self._writer = writer
+
+    def add_paragraph(self, text=""):
+        paragraph = Paragraph(self._writer)
+        if text:
+            paragraph.add_run(text)
+        self.paragraphs.append(paragraph)
+        return paragraph
+
+    def xml(self, width):
+        return ('<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="%d"/></w:tcPr>' % Emu(width).twips
+                + "".join(paragraph.xml() for paragraph in self.paragraphs) + "</w:tc>")
+
+
+class TableWriter:
+    '''appends rows to a python-docx table, add_row returns the cells of a new row like table.add_row().cells.
+    new_row, row_xml and add_xml do the same in steps, for callers that keep the XML of a row (see fragments.py)'''
+
+    def __init__(self, document, table, widths):
+        self._part = document.part
+        self._tbl = table._tbl  # pylint: disable=W0212
+        self._widths = widths
+        self._rows = []
+        self._next_id = None
+
+    def add_row(self):
+        if len(self._rows) >= CHUNK_ROWS:
+            self.flush()
+        cells = self.new_row()
+        self._rows.append(cells)
+        return cells
+
+    def new_row(self):
+        '''cells of a row that is not added to the table yet'''
+        return [Cell(self) for _ in self._widths]
+
+    def row_xml(self, cells):
+        return "<w:tr>" + "".join(cell.xml(width) for cell, width in zip(cells, self._widths)) + "</w:tr>"
+
+    def add_xml(self, xml):
+        '''append a row given as XML, as returned by row_xml'''
+        if len(self._rows) >= CHUNK_ROWS:
+            self.flush()
+        self._rows.append(xml)
+
+    def picture_xml(self, image_descriptor, width):
+        rId, image = self._part.get_or_add_image(image_descriptor)
+        cx, cy = image.scaled_dimensions(width, None)
+        if self._next_id is None:
+            # python-docx scans the whole document for every picture, ids are counted here instead
+            self._next_id = self._part.next_id
+        shape_id = self._next_id
+        self._next_id += 1
+        return INLINE_XML % {"cx": cx, "cy": cy, "id": shape_id, "rId": rId,
+                             "filename": '"' + escape(image.filename, {'"': "&quot;"}) + '"'}
+
+    def flush(self):
+        '''parse the pending rows and append them to the table'''
+        if not self._rows:
+            return
+        rows = "".join(row if isinstance(row, str) else self.row_xml(row) for row in self._rows)
+        for tr in parse_xml("<w:tbl %s>%s</w:tbl>" % (nsdecls("w", "wp", "r"), rows)):
+            self._tbl.append(tr)
+        self._rows = []